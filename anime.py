@@ -1,326 +1,580 @@
 import json
-from bisect import bisect_left
+from argparse import ArgumentParser
+from collections import Counter
 from colorsys import hsv_to_rgb, rgb_to_hsv
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
-from io import BytesIO
-from itertools import accumulate
-from math import ceil, nan
-from operator import truediv
+from math import ceil
 from re import compile
+from typing import Iterable, Iterator
+from threading import Lock
+import logging
 import time
 
-import jieba
 import PIL.Image
 import telebot
 from more_itertools import chunked
 from PIL.ImageColor import getrgb
-from PIL.ImageDraw import Draw
-from PIL.ImageEnhance import Brightness
-from PIL.ImageFilter import GaussianBlur
-from PIL.ImageFont import FreeTypeFont, truetype
-from requests import get, post
+from PIL.ImageDraw import ImageDraw
+from requests import RequestException
 
+from cache import Cache, Write
+from color import Dominant
+import images
+from layout import Wrap
+from metrics import METRICS, Span
+from net import HTTP, Map, RateLimit
+from pool import Imap, Prefetch
+from segment import Cut
+from send import RATE, Sender
+from fonts import Text
+from template import Encoder, Fill, Line, Stack, Tags, Template
 
-def Fetch(start: datetime, end: datetime) -> list[dict]:
+log = logging.getLogger(__name__)
+
+ANILIST = 'https://graphql.anilist.co'
+BGM = 'https://api.bgm.tv'
+
+SUBJECTS = Cache('cache/subjects.db', 4096)  # bgm.tv lookups, keyed by AniList id and native title
+STATIC_TTL = 90 * 86400  # Names and summaries rarely change
+SCORE_TTL = 3 * 86400
+MEDIA = Cache('cache/media.db', 4096)  # AniList details by media id, or a marker for ones the filters leave out
+MEDIA_TTL = 12 * 3600  # Episode counts and descriptions do get updated
+MESSAGE_ID = 'message_id'  # Albums pinned by the last run, per chat
+
+
+@dataclass(slots=True)
+class Show:
+    """一部番剧在一个时间点播出的一集或几集, 已补上 bgm.tv 的信息; Card 和推送的标题用的都是它"""
+    id: int
+    airingAt: int
+    episode: int
+    episodeUntil: int | None  # Last episode, when several air at once
+    episodes: int | None  # In total, if known
+    native: str  # bgm.tv's Chinese name once found
+    romaji: str
+    cover: str | None  # None once it could not be downloaded
+    color: str | None
+    format: str
+    source: str
+    duration: int | None
+    genres: list[str]
+    studios: list[str]  # Animation studios only
+    description: str  # bgm.tv's summary once found
+    score: float = 0
+    no_space: bool = False  # Description is segmented Chinese
+    bgm_id: int | None = None
+    rgb: tuple[int, int, int] | None = None  # Of color, or of the cover when AniList has none; see Color
+
+    @classmethod
+    def parse(cls, media: dict, airingAt: int, episode: int, until: int) -> 'Show':
+        return cls(
+            id=media['id'],
+            airingAt=airingAt,
+            episode=episode,
+            episodeUntil=until if until != episode else None,
+            episodes=media['episodes'],
+            native=media['title']['native'],
+            romaji=media['title']['romaji'],
+            cover=media['coverImage']['extraLarge'],
+            color=media['coverImage']['color'],
+            format=media['format'],
+            source=media['source'],
+            duration=media['duration'],
+            genres=media['genres'],
+            studios=[studio['name'] for studio in media['studios']['nodes'] if studio['isAnimationStudio']],
+            description=media['description'],
+        )
+
+
+def Media(ids: list[int], workers=8, limit: RateLimit = RateLimit()) -> dict[int, dict]:
+    """AniList 上通过筛选的番剧详情, 按 id; 先查缓存, 其余每 50 个一批, 筛选在服务端做"""
+    # language=graphql
+    query = """query ($ids: [Int]) {
+    Page(perPage: 50) {
+        media(id_in: $ids, type: ANIME, countryOfOrigin: "JP", format_in: [TV, MOVIE, TV_SHORT, ONA], genre_not_in: ["Hentai"]) {
+            id
+            title {
+                native
+                romaji
+            }
+            coverImage {
+                extraLarge
+                color
+            }
+            episodes
+            format
+            source
+            duration
+            genres
+            studios {
+                nodes {
+                    name
+                    isAnimationStudio
+                }
+            }
+            description
+        }
+    }
+}"""
+    out = {}
+    todo = []
+    for id in dict.fromkeys(ids):
+        r = MEDIA.get(str(id), STATIC_TTL)
+        if r is None or 'media' in r and time.time() - r['fetched'] > MEDIA_TTL:
+            todo.append(id)
+        elif 'media' in r:
+            out[id] = r['media']
+
+    def Batch(ids: list[int]) -> list[dict]:
+        limit(ANILIST)
+        with Span('anilist_media'):
+            return HTTP.post(ANILIST, json={'query': query, 'variables': {'ids': ids}}).json()['data']['Page']['media']
+
+    batches = list(chunked(todo, 50))
+    for batch, media in zip(batches, Map(Batch, batches, workers)):
+        found = {m['id']: m for m in media}
+        for id in batch:
+            if id in found:
+                out[id] = found[id]
+                MEDIA.set(str(id), {'media': found[id], 'fetched': time.time()})
+            else:
+                MEDIA.set(str(id), {'skip': True})  # Filtered out, country and format hardly ever change
+    return out
+
+
+def Schedules(start: datetime, end: datetime, workers=8, rate=5.0) -> list[Show]:
+    """AniList 上的放送时间表, 已过滤, 同一部番剧同时播出的几集合为一条
+
+    先只取每一集的时间和番剧 id, 合并后再批量取详情
+    """
     # language=graphql
     query = """query ($page: Int = 1, $greater: Int, $lesser: Int) {
-    Page(page: $page) {
+    Page(page: $page, perPage: 50) {
         pageInfo {
             hasNextPage
-            total
+            lastPage
         }
         airingSchedules(airingAt_greater: $greater, airingAt_lesser: $lesser, sort: [TIME, EPISODE]) {
             episode
             airingAt
-            media {
-                id
-                title {
-                    native
-                    romaji
-                }
-                coverImage {
-                    extraLarge
-                    color
-                }
-                episodes
-                type
-                countryOfOrigin
-                format
-                source
-                duration
-                genres
-                studios {
-                    nodes {
-                        name
-                        isAnimationStudio
-                    }
-                }
-                description
-            }
+            mediaId
         }
     }
 }"""
-    out = []
-    for page in range(100):
-        r = post('https://graphql.anilist.co', json={'query': query, 'variables': {'page': page, 'greater': start.timestamp() - 1, 'lesser': end.timestamp()}}).json()['data']['Page']
-        out += r['airingSchedules']
-        if not r['pageInfo']['hasNextPage']: break
+    limit = RateLimit(rate)
+
+    def Page(page: int) -> dict:
+        limit(ANILIST)
+        with Span('anilist_page'):
+            return HTTP.post(ANILIST, json={'query': query, 'variables': {'page': page, 'greater': start.timestamp() - 1, 'lesser': end.timestamp()}}).json()['data']['Page']
 
-    out = [s for s in out if s['media']['countryOfOrigin'] == 'JP' and s['media']['type'] == 'ANIME' and s['media']['format'] in ['TV', 'MOVIE', 'TV_SHORT', 'ONA'] and 'Hentai' not in s['media']['genres']]
+    # The first page tells how many there are, the rest are fetched together
+    r = Page(1)
+    out = r['airingSchedules']
+    if r['pageInfo']['hasNextPage']:
+        for r in Map(Page, range(2, min(r['pageInfo']['lastPage'], 100) + 1), workers):
+            out += r['airingSchedules']
 
-    # Deduplicate
+    # Episodes of a show airing at the same time
     # ----------------------------------------
-    index = {}
-    i = 0
-    while i < len(out):
-        q = out[i]['media']['id'], out[i]['airingAt']
-        if q in index:
-            out[index[q]]['episodeUntil'] = out.pop(i)['episode']
-        else:
-            index[q] = i
-            i += 1
+    groups = {}  # (media id, airingAt) -> [first, last] episode, in airing order
+    for s in out:
+        r = groups.setdefault((s['mediaId'], s['airingAt']), [s['episode'], s['episode']])
+        r[0] = min(r[0], s['episode'])
+        r[1] = max(r[1], s['episode'])
+    METRICS.count('dropped_total', len(out) - len(groups), reason='merged')
+
+    media = Media([id for id, _ in groups], workers, limit)
+    shows = [Show.parse(media[id], at, *episodes) for (id, at), episodes in groups.items() if id in media]
+    METRICS.count('dropped_total', len(groups) - len(shows), reason='filtered')
+    return shows
 
-    for l in range(len(out)):
-        out[l]['media']['score'] = 0
-        out[l]['media']['no_space'] = False
-        out[l]['bgm_id'] = None
+
+def Enrich(out: list[Show], workers=8, rate=5.0) -> Iterator[Show]:
+    """补充 bgm.tv 的中文名, 简介和评分, 按原有顺序逐个产出"""
+    limit = RateLimit(rate)
+
+    def Search(native: str):
+        url = f'{BGM}/search/subject/{native}'
+        limit(url)
         try:
-            r = get(f'https://api.bgm.tv/search/subject/{out[l]["media"]["title"]["native"]}', 
-            params = {"type": 2, "responseGroup": "large", "start": 0, "max_results": 1}).json()['list'][0]
-        except:
-            continue
-        out[l]['media']['no_space'] = True
-        out[l]['bgm_id'] = r['id']
-        out[l]['media']['title']['native'] = r['name_cn'] or out[l]['media']['title']['native']
-        out[l]['media']['description'] = ' '.join(jieba.cut(r['summary'])) or out[l]['media']['description']
-        out[l]['media']['score'] = r['rating']['score'] if r.get('rating') else 0
+            with Span('bgm_search'):
+                r = HTTP.get(url, params={"type": 2, "responseGroup": "large", "start": 0, "max_results": 1}).json()['list'][0]
+        except RequestException:
+            METRICS.count('degraded_total', reason='bgm_unavailable')
+            return None  # bgm.tv is down, try again next run
+        except (KeyError, IndexError, TypeError, ValueError):  # E.g. {"code": 404} instead of a list
+            return {'id': None, 'scored': time.time(), 'fetched': time.time()}  # Not on bgm.tv (yet), retried once the score expires
+        return {
+            'id': r['id'],
+            'name_cn': r['name_cn'],
+            'summary': Cut(r['summary']),
+            'score': r['rating']['score'] if r.get('rating') else 0,
+            'scored': time.time(),
+            'fetched': time.time(),  # Refreshing the score keeps this, so names and summaries still expire
+        }
 
-    return out
+    def Score(hit: dict) -> dict:
+        url = f'{BGM}/v0/subjects/{hit["id"]}'
+        limit(url)
+        try:
+            with Span('bgm_subject'):
+                r = HTTP.get(url).json()
+            hit['score'] = r['rating']['score'] if r.get('rating') else 0
+        except (RequestException, KeyError, IndexError, TypeError, ValueError):
+            pass  # Keep the stale score
+        hit['scored'] = time.time()
+        return hit
 
+    def Subject(s: Show) -> Show:
+        key = f'{s.id}/{s.native}'
+        r = SUBJECTS.get(key)
+        if r is None or time.time() - r.get('fetched', 0) > STATIC_TTL or r['id'] is None and time.time() - r['scored'] > SCORE_TTL:
+            r = Search(s.native) or r  # The stale entry, if any, while bgm.tv is down
+            if r is None: return s
+            SUBJECTS.set(key, r)
+        elif time.time() - r['scored'] > SCORE_TTL:
+            SUBJECTS.set(key, Score(r))
+        if r['id'] is None: return s
+        s.no_space = True
+        s.bgm_id = r['id']
+        s.native = r['name_cn'] or s.native
+        s.description = r['summary'] or s.description
+        s.score = r['score']
+        return s
 
-def Wrap(text: str, width: float, font: FreeTypeFont, line=-1, no_space=False) -> list[str]:
-    space = font.getlength(' ')
-    dots = font.getlength('[...]')
-    words = text.split()
-    lens = tuple(accumulate(map(space.__add__, map(font.getlength, words))))  # Widths of words, each plus a space
-    out = []
-    w = width + space
-    while line and words:
-        i = bisect_left(lens, w)
-        if line == 1:
-            for j in reversed(range(i)):
-                dots -= lens[j]
-                if dots > 0:
-                    words[j] = ''
-                else:
-                    words[j] = '[...]'
-                    break
-        if no_space:
-            out.append(''.join(words[:i]))
-        else:
-            out.append(' '.join(words[:i]))
-        w = width + lens[i - 1] + space  # Ignore space at line end
-        words = words[i:]
-        lens = lens[i:]
-        line -= 1
-    return out
+    yield from Imap(Subject, out, workers, threads=True)
 
 
-def Card(info: list[dict]) -> list[bytes]:
-    re0 = compile(r'Season (\d+)')  # E.g., Season 2 -> 2
-    re1 = compile(r'<.*?>')  # E.g., <br>, <i>
-    re2 = compile(r'\(Source: .*?\)')  # Usually at end
-    re3 = compile(r'Note: .*')  # Usually at end
+def Fetch(start: datetime, end: datetime, workers=8, rate=5.0) -> list[Show]:
+    return list(Enrich(Schedules(start, end, workers, rate), workers, rate))
 
-    fontM = truetype('font/iosevka-bold.ttf', 72)
-    fontS = truetype('font/NotoSansSymbols2-Regular.ttf', 40)
-    # fontJ = truetype('font/sarasa-ui-j-regular.ttf', 48)
-    # font1 = truetype('font/OpenSans-VariableFont_wdth,wght.ttf', 24)
-    font1 = truetype('font/NotoSansSC-Medium.otf', 24)
-    font2 = font1.font_variant(size=36)
-    font3 = font1.font_variant(size=48)
-    # font1.set_variation_by_name('Condensed Bold')
-    # font2.set_variation_by_name('Condensed Bold')
-    # font3.set_variation_by_name('Condensed Bold')
 
-    formats = {'TV_SHORT': 'TV Short', 'MOVIE': 'Movie'}
-    sources = {'ORIGINAL': '原创', 'LIGHT_NOVEL': '轻小说改编', 'VISUAL_NOVEL': '视觉小说改编', 'VIDEO_GAME': '游戏改编', 'MANGA': '漫画改编', 'NOVEL': '小说改编', 'OTHER': '其他'}
+re0 = compile(r'Season (\d+)')  # E.g., Season 2 -> 2
+re1 = compile(r'<.*?>')  # E.g., <br>, <i>
+re2 = compile(r'\(Source: .*?\)')  # Usually at end
+re3 = compile(r'Note: .*')  # Usually at end
 
-    out = []
-    for data in info:
-        image = PIL.Image.new('RGB', (1000, 650), '#222526')
-        draw = Draw(image)
-        xl = 490
-        width = 500
-        color = getrgb(data['media']['coverImage']['color'] or '#73B9DF')
-
-        # Thumbnail
-        # ----------------------------------------
-        with PIL.Image.open(BytesIO(get(data['media']['coverImage']['extraLarge']).content)) as thumb:
-            size = (460, 650)  # Thumbnail size
-            r = min(map(truediv, thumb.size, size))
-            w = r * size[0]
-            h = r * size[1]
-            l = max(0, (thumb.size[0] - w) / 2)
-            t = max(0, (thumb.size[1] - h) / 2)
-            r = min(thumb.size[0], (thumb.size[0] + w) / 2)
-            b = min(thumb.size[1], (thumb.size[1] + h) / 2)
-            image.paste(thumb.resize(size, 1, (l, t, r, b), 2))  # Lanczos
-
-            size = (540, 650)  # TODO: Don't hardcode
-            r = 0.5 * min(map(truediv, thumb.size, size))
-            w = r * size[0]
-            h = r * size[1]
-            l = max(0, (thumb.size[0] - w) / 2)
-            t = max(0, (thumb.size[1] - h) / 2)
-            r = min(thumb.size[0], (thumb.size[0] + w) / 2)
-            b = min(thumb.size[1], (thumb.size[1] + h) / 2)
-            image.paste(Brightness(thumb.resize(size, 1, (l, t, r, b), 2)).enhance(0.25).filter(GaussianBlur(9)), (460, 0))
-
-        # Episode
-        # ----------------------------------------
-        yt = 30
-        margin = 14
-        episode = "{} {}{} / {} 的播出时间".format(
-            (data['episode'] == data['media']['episodes'] or data.get('episodeUntil', nan) == data['media']['episodes']) and 'Final ep' or 'Ep',
-            data['episode'],
-            'episodeUntil' in data and f"-{data['episodeUntil']}" or '',
-            data['media']['episodes'] or '?',
-            # 'episodeUntil' in data and 'are' or 'is',
-        )
-        _, t, _, b = font1.getbbox('A')
-        yt += b - t
-        draw.text((xl, yt), episode, 'darkgray', font1, 'ls')
-        yt += margin
-
-        # Airing at
-        # ----------------------------------------
-        t = datetime.fromtimestamp(data['airingAt'])
+formats = {'TV_SHORT': 'TV Short', 'MOVIE': 'Movie'}
+sources = {'ORIGINAL': '原创', 'LIGHT_NOVEL': '轻小说改编', 'VISUAL_NOVEL': '视觉小说改编', 'VIDEO_GAME': '游戏改编', 'MANGA': '漫画改编', 'NOVEL': '小说改编', 'OTHER': '其他'}
+
+
+CARD = Template((1000, 650), '#222526', {
+    'M': ('font/iosevka-bold.ttf', 72),
+    'S': ('font/NotoSansSymbols2-Regular.ttf', 40),
+    '1': ('font/NotoSansSC-Medium.otf', 24),
+    '2': ('font/NotoSansSC-Medium.otf', 36),
+    '3': ('font/NotoSansSC-Medium.otf', 48),
+}, {
+    'thumb': (0, 0, *images.THUMB),
+    'panel': (images.THUMB[0], 0, 1000, 650),
+    'text': (490, 30, 990, 550),  # Header grows down from the top, title and studio grow up from the bottom
+    'score': (865, 60, 910, 60),  # Baselines of the star and the number
+    'tags': (490, 610, 990, 610),
+}, cache='cache/cards/anime')
+
+
+def Color(show: Show) -> tuple[int, int, int]:
+    """主题色, Head 和 Body 都要; 从封面算时每部番剧只解码一次"""
+    if show.rgb is None:
+        if show.color:
+            show.rgb = getrgb(show.color)
+        elif show.cover is None:
+            show.rgb = getrgb('#73B9DF')
+        else:
+            show.rgb, _ = Dominant(images.COVERS.get(show.cover), getrgb('#73B9DF'))
+    return show.rgb
+
+
+def Head(show: Show, draw: ImageDraw = None) -> float:
+    """头部: 集数, 放送时间, 类型和来源, 每期都变; 返回头部下方的 yt, draw 为 None 时只算位置"""
+    fonts = CARD.fonts
+    font1 = fonts['1']
+    xl, yt, _, _ = CARD.regions['text']
+
+    # Episode
+    # ----------------------------------------
+    margin = 14
+    episode = "{} {}{} / {} 的播出时间".format(
+        show.episodes and show.episodes in (show.episode, show.episodeUntil) and 'Final ep' or 'Ep',
+        show.episode,
+        show.episodeUntil is not None and f"-{show.episodeUntil}" or '',
+        show.episodes or '?',
+    )
+    yt = Line(draw, xl, yt, episode, font1, 'darkgray', margin)
+
+    # Airing at
+    # ----------------------------------------
+    l, t, r, b = fonts['M'].getbbox('0')
+    yt += b - t
+    if draw:
+        color = Color(show)
+        t = datetime.fromtimestamp(show.airingAt)
         hh = f"{t.hour:02}"
         mm = f"{t.minute:02}"
         tmr = date.today() < t.date() and '+' or ''
-        l, t, r, b = fontM.getbbox('0')
-        yt += b - t
         h, s, v = rgb_to_hsv(*color)
         rgb = tuple(map(round, hsv_to_rgb(h, s * 0.4, v)))
-        draw.text((xl - 3, yt), hh, color, fontM, 'ls')
-        draw.text((xl - 3 + 2 * (r - l), yt), mm, rgb, fontM, 'ls')
-        draw.text((xl - 3 + 4 * (r - l), yt), tmr, 'white', fontM, 'ls')
-        yt += margin
-
-        # Format and source
-        # ----------------------------------------
-        format = formats.get(data['media']['format'], data['media']['format'])
-        source = sources.get(data['media']['source'], data['media']['source'].replace('_', ' ').title())
-        duration = data['media']['duration'] and f" ({data['media']['duration']} min.)" or ''
-        _, t, _, b = font1.getbbox('A')
-        yt += b - t
-        draw.text((xl, yt), f"{format}{duration} | {source}", 'white', font1, 'ls')
-        yt += margin * 1.5
-
-        # Score
-        # ----------------------------------------
-        if score := data['media']['score']:
-            draw.text((865, 60), '\u2730', score >= 6 and 'gold' or score >= 5 and 'silver' or 'Sienna', fontS, 'ls')
-            draw.text((910, 60), f"{data['media']['score']}", 'white', font2, 'ls')
-
-        # Studio
-        # ----------------------------------------
-        yb = 550
-        margin = 16
-        studio = [studio['name'] for studio in data['media']['studios']['nodes'] if studio['isAnimationStudio']]
-        _, t, _, b = font2.getbbox('A')
-        spacing = 12
-        yb -= (len(studio) - 1) * (b - t + spacing)
-        draw.multiline_text((xl, yb), '\n'.join(studio), color, font2, 'ls', spacing - t)
-        yb -= (b - t) + margin
-
-        # Title
-        # ----------------------------------------
-        _title = data['media']['title']['native'] 
-        native = re0.sub(r'\1', (_title if len(_title) < 9 else _title[:9] + " ...") or '').replace('’', "'")
-        romaji = re0.sub(r'\1', data['media']['title']['romaji'] or '').replace('’', "'")
-        if not native or native.casefold() == romaji.casefold():
-            romaji = Wrap(romaji, width, font3)
-            _, t, _, b = font3.getbbox('A')
-            spacing = 14
-            yb -= (len(romaji) - 1) * (b - t + spacing)
-            draw.multiline_text((xl, yb), '\n'.join(romaji), 'white', font3, 'ls', spacing - t)
-            yb -= (b - t) + margin * 1.5
+        Text(draw, (xl - 3, yt), hh, color, fonts['M'])
+        Text(draw, (xl - 3 + 2 * (r - l), yt), mm, rgb, fonts['M'])
+        Text(draw, (xl - 3 + 4 * (r - l), yt), tmr, 'white', fonts['M'])
+    yt += margin
+
+    # Format and source
+    # ----------------------------------------
+    format = formats.get(show.format, show.format)
+    source = sources.get(show.source, show.source.replace('_', ' ').title())
+    duration = show.duration and f" ({show.duration} min.)" or ''
+    return Line(draw, xl, yt, f"{format}{duration} | {source}", font1, 'white', margin * 1.5)
+
+
+def Body(show: Show) -> PIL.Image.Image:
+    """头部以外的部分, 一部番剧每周都一样"""
+    fonts = CARD.fonts
+    font1 = fonts['1']
+    xl, _, xr, yb = CARD.regions['text']
+    width = xr - xl
+    color = Color(show)
+    image, draw = CARD.new(show.cover)
+    yt = Head(show)
+
+    # Score
+    # ----------------------------------------
+    if score := show.score:
+        xs, ys, xn, yn = CARD.regions['score']
+        Text(draw, (xs, ys), '\u2730', score >= 6 and 'gold' or score >= 5 and 'silver' or 'Sienna', fonts['S'])
+        Text(draw, (xn, yn), f"{score}", 'white', fonts['2'])
+
+    # Studio
+    # ----------------------------------------
+    margin = 16
+    yb = Stack(draw, xl, yb, show.studios, fonts['2'], color, 12, margin)
+
+    # Title
+    # ----------------------------------------
+    _title = show.native
+    native = re0.sub(r'\1', (_title if len(_title) < 9 else _title[:9] + " ...") or '').replace('’', "'")
+    romaji = re0.sub(r'\1', show.romaji or '').replace('’', "'")
+    if not native or native.casefold() == romaji.casefold():
+        yb = Stack(draw, xl, yb, Wrap(romaji, width, fonts['3']), fonts['3'], 'white', 14, margin * 1.5)
+    else:
+        yb = Stack(draw, xl, yb, Wrap(romaji, width, font1), font1, 'white', 10, margin)
+        yb = Stack(draw, xl, yb, Wrap(native, width, fonts['3']), fonts['3'], 'white', 14, margin * 1.5)
+
+    # Description
+    # ----------------------------------------
+    desc = re3.sub('', re2.sub('', re1.sub('', show.description.replace('’', "'"))))
+    Fill(draw, xl, yt, yb, desc, width, font1, 'gray', 10, no_space=show.no_space)
+
+    # Genre
+    # ----------------------------------------
+    h, s, v = rgb_to_hsv(*color)
+    rgb = tuple(map(round, hsv_to_rgb(h, s, v * 0.6)))
+    xl, y, xr, _ = CARD.regions['tags']
+    Tags(draw, xl, y, xr, show.genres, font1, rgb)
+
+    return image
+
+
+def Render(show: Show) -> tuple[bytes, Show]:
+    head = {k: getattr(show, k) for k in ('episode', 'episodeUntil', 'airingAt', 'episodes', 'format', 'source', 'duration')}
+    head.update(today=date.today())
+    body = {k: getattr(show, k) for k in ('score', 'studios', 'native', 'romaji', 'description', 'no_space', 'genres', 'color')}
+    try:
+        body.update(cover=images.COVERS.digest(show.cover))
+    except RequestException as e:  # One cover must not stop the push, the card goes out without it
+        log.warning('cover of %s unavailable: %s', show.id, e)
+        METRICS.count('degraded_total', reason='cover')
+        show.cover = None
+        body.update(cover=None)
+    card = CARD.render(head, body, lambda: Body(show), lambda draw: Head(show, draw))
+    return card, show
+
+
+def Card(info: list[Show], workers=1) -> list[tuple[bytes, Show]]:
+    return list(Imap(Render, info, workers, CARD.load))
+
+
+def Push(sender: Sender, cards: Iterable, total: int, isoformat: str, title: str = '今日放送番剧') -> list[int]:
+    """每 10 张卡片发送一组并置顶, 下一组在发送期间继续渲染; 返回或出错时关闭 cards"""
+    msg_list = []
+    chunks = Prefetch(chunked(cards, 10), 1)
+    try:
+        for i, chunk in enumerate(chunks):
+            media = list(map(lambda p: telebot.types.InputMediaPhoto(p[0]), chunk))
+            media[0].caption = f"`{title}\n{i + 1}/{total} {isoformat}`\n"
+            for _, show in chunk:
+                media[0].caption += f"\n  - [{show.native}](https://t.me/BangumiBot?start={show.bgm_id})"
+            media[0].parse_mode = 'markdown'
+            msg = sender.send_media_group(media)
+            msg_list.append(msg[0].message_id)
+            sender.pin(msg[0].message_id)
+    finally:
+        chunks.close()  # Stops the prefetching thread
+        if hasattr(cards, 'close'): cards.close()  # E.g. an Imap, so its pool shuts down
+    return msg_list
+
+
+@dataclass
+class Job:
+    """推送到一个频道的一批卡片: 放送时间窗口和筛选条件"""
+    chat_id: int
+    start: datetime
+    days: int = 1
+    title: str = '今日放送番剧'
+    formats: list[str] | None = None  # AniList formats to keep, all by default
+    genres: list[str] | None = None  # Keep only shows with any of these
+    exclude: list[str] = field(default_factory=list)  # Drop shows with any of these genres
+
+    @property
+    def end(self) -> datetime:
+        return self.start + timedelta(self.days)
+
+    @property
+    def isoformat(self) -> str:
+        if self.days == 1: return self.start.date().isoformat()
+        return f'{self.start.date().isoformat()} ~ {(self.end - timedelta(1)).date().isoformat()}'
+
+    def __contains__(self, show: Show) -> bool:
+        return (
+            self.start.timestamp() <= show.airingAt < self.end.timestamp()
+            and (self.formats is None or show.format in self.formats)
+            and (self.genres is None or any(genre in self.genres for genre in show.genres))
+            and not any(genre in self.exclude for genre in show.genres)
+        )
+
+    @classmethod
+    def parse(cls, entry: dict, today: datetime) -> 'Job':
+        """{"chat": id, "offset": 0, "days": 1, "hour": 17, "title": ..., "formats": [...], "genres": [...], "exclude": [...]}, offset 是距今天的天数"""
+        entry = dict(entry)
+        start = today.replace(hour=entry.pop('hour', 17), minute=0, second=0, microsecond=0) + timedelta(entry.pop('offset', 0))
+        return cls(entry.pop('chat'), start, **entry)
+
+
+def Jobs(path: str, today: datetime = None) -> list[Job]:
+    with open(path) as f:
+        return [Job.parse(entry, today or datetime.now()) for entry in json.load(f)]
+
+
+def Windows(jobs: list[Job]) -> list[list[datetime]]:
+    """各任务时间窗口的并集, 重叠或相接的合成一段"""
+    out = []
+    for job in sorted(jobs, key=lambda job: job.start):
+        if out and job.start <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], job.end)
         else:
-            romaji = Wrap(romaji, width, font1)
-            _, t, _, b = font1.getbbox('A')
-            spacing = 10
-            yb -= (len(romaji) - 1) * (b - t + spacing)
-            draw.multiline_text((xl, yb), '\n'.join(romaji), 'white', font1, 'ls', spacing - t)
-            yb -= (b - t) + margin
-            native = Wrap(native, width, font3)
-            _, t, _, b = font3.getbbox('A')
-            spacing = 14
-            yb -= (len(native) - 1) * (b - t + spacing)
-            draw.multiline_text((xl, yb), '\n'.join(native), 'white', font3, 'ls', spacing - t)
-            yb -= (b - t) + margin * 1.5
-
-        # Description
-        # ----------------------------------------
-        desc = re3.sub('', re2.sub('', re1.sub('', data['media']['description'].replace('’', "'"))))
-        _, t, _, b = font1.getbbox('A')
-        spacing = 10
-        yt += b - t
-        desc = Wrap(desc, width, font1, ceil((yb - yt + spacing) / (b - t + spacing)), no_space=data['media']['no_space'])
-        draw.multiline_text((xl, yt), '\n'.join(desc), 'gray', font1, 'ls', spacing - t)
-
-        # Genre
-        # ----------------------------------------
-        y = 610
-        border = 7
-        xr = xl + width
-        h, s, v = rgb_to_hsv(*color)
-        rgb = tuple(map(round, hsv_to_rgb(h, s, v * 0.6)))
-        for genre in data['media']['genres']:
-            l, t, r, b = draw.textbbox((xl, y), genre, font1, 'ls')
-            if r + 2 * border > xr: break  # Exceeding tags are dropped
-            draw.rectangle((l, y - border, r + 2 * border, y + border), rgb)
-            draw.text((l + border, y), genre, 'white', font1, 'ls')
-            xl += r - l + border * 4  # Move right
-
-        # Export
-        # ----------------------------------------
-        file = BytesIO()
-        image.save(file, 'PNG')  # .tobytes() is not for this
-        out.append([file.getvalue(), [data['bgm_id'], data['media']['title']['native']]])
+            out.append([job.start, job.end])
+    return out
+
+
+class Cards:
+    """所有任务共用的卡片: 按放送顺序渲染, 每部番剧每个时间点只渲染一次, 哪个任务先要就先渲染到哪里
 
+    uses 是每张卡片有几个任务要; 最后一个任务取走后就不再留着, 只有一个任务时和直接推送一样不占内存
+    """
+
+    def __init__(self, shows: Iterable[Show], uses: dict[tuple[int, int], int], workers=1):
+        self.rendered = Imap(Render, shows, workers, CARD.load)  # Lazy, nothing is rendered before it is needed
+        self.cards = {}  # (id, airingAt) -> (card, show), rendered but not taken by every job yet
+        self.uses = dict(uses)
+        self.lock = Lock()
+
+    def __getitem__(self, show: Show) -> tuple[bytes, Show]:
+        key = show.id, show.airingAt
+        with self.lock:
+            while key not in self.cards:
+                card, rendered = next(self.rendered)
+                self.cards[rendered.id, rendered.airingAt] = card, rendered
+            self.uses[key] -= 1
+            return self.cards[key] if self.uses[key] else self.cards.pop(key)
+
+    def close(self) -> None:
+        with self.lock:
+            self.rendered.close()
+
+
+def Batch(bot: telebot.TeleBot, jobs: list[Job], workers=1, rate=RATE, fetch_workers=8, fetch_rate=5.0) -> dict[int, list[int]]:
+    """一次做完所有任务: 时间窗口的并集只取一次, 每张卡片只渲染一次, 再分发到各频道
+
+    各频道同时推送 (Telegram 的限制是按频道的), 同一频道的任务依次推送; 返回每个频道新发的相册的 message_id
+    workers 是渲染进程数, rate 是每个频道的发送速率; fetch_workers 和 fetch_rate 用于 AniList 和 bgm.tv
+    """
+    shows = []
+    windows = Windows(jobs)
+    for start, end in windows:  # Disjoint, so no show is fetched twice
+        shows += Schedules(start, end, fetch_workers, fetch_rate)
+    selected = [[show for show in shows if show in job] for job in jobs]
+    wanted = Counter((show.id, show.airingAt) for chosen in selected for show in chosen)
+    cards = Cards(Enrich([show for show in shows if (show.id, show.airingAt) in wanted], fetch_workers, fetch_rate), wanted, workers)
+
+    chats = {}
+    for job, chosen in zip(jobs, selected):
+        chats.setdefault(job.chat_id, []).append((job, chosen))
+
+    def Channel(chat_id: int) -> list[int]:
+        sender = Sender(bot, chat_id, rate)
+        msg_list = []
+        for job, chosen in chats[chat_id]:
+            msg_list += Push(sender, (cards[show] for show in chosen), ceil(len(chosen) / 10), job.isoformat, job.title)
+        sender.close()
+        log.info('push %s: %s', chat_id, sender)
+        return msg_list
+
+    try:
+        out = dict(zip(chats, Map(Channel, chats, len(chats))))
+    finally:
+        cards.close()  # A failed channel must not leave render workers behind
+
+    # What the jobs had in common
+    # ----------------------------------------
+    asked = sum(job.days for job in jobs)
+    fetched = sum((end - start) / timedelta(1) for start, end in windows)
+    pushed = sum(map(len, selected))
+    METRICS.count('batch_shared_total', asked - fetched, stage='fetch_days')
+    METRICS.count('batch_shared_total', pushed - len(wanted), stage='render')
+    log.info('batch: %d jobs in %d channels, %g of %g days fetched, %d cards pushed from %d renders', len(jobs), len(chats), fetched, asked, pushed, len(wanted))
     return out
 
 
-def Task() -> None:
+def Task(workers=1, jobs: list[Job] = None, fetch_workers=8, fetch_rate=5.0) -> None:
+    """jobs 默认是今天 17 点起 24 小时, 推送到 send_id"""
     send_id = 0
     start = datetime.now()
     start = start.replace(hour=17, minute=0, second=0, microsecond=0)
-    cards = Card(Fetch(start, start + timedelta(1)))
-    total = ceil(len(cards) / 10)
-    isoformat = start.date().isoformat()
+    jobs = jobs or [Job(send_id, start)]
     bot = telebot.TeleBot('token') # set your token here
-    msg_list = []
-    for i, chunk in enumerate(chunked(cards, 10)):
-        media = list(map(lambda p: telebot.types.InputMediaPhoto(p[0]), chunk))
-        media[0].caption = f"`今日放送番剧\n{i + 1}/{total} {isoformat}`\n"
-        for d in chunk:
-            media[0].caption += f"\n  - [{d[1][1]}](https://t.me/BangumiBot?start={d[1][0]})"
-        media[0].parse_mode = 'markdown'
-        msg = bot.send_media_group(send_id, media)
-        msg_list.append(msg[0].message_id)
-        if len(cards) > 10: time.sleep(60)
-    for id in msg_list:
-        bot.pin_chat_message(send_id, id, disable_notification=True)
-    f = open("./message_id", "r+")
-    old_msg_list = json.loads(f.read())
-    f.seek(0)
-    f.truncate()
-    f.write(json.dumps(msg_list))
-    f.close()
-    for oid in old_msg_list:
-        bot.unpin_chat_message(send_id, oid)
+    msg_lists = Batch(bot, jobs, workers, fetch_workers=fetch_workers, fetch_rate=fetch_rate)
+    try:
+        with open(MESSAGE_ID) as f:
+            old_msg_lists = json.load(f)
+    except FileNotFoundError:
+        old_msg_lists = {}
+    if isinstance(old_msg_lists, list): old_msg_lists = {str(send_id): old_msg_lists}  # Written before there were several channels
+    Write(MESSAGE_ID, json.dumps({**old_msg_lists, **{str(chat_id): msg_list for chat_id, msg_list in msg_lists.items()}}).encode(), sync=True)
+    for chat_id in msg_lists:
+        sender = Sender(bot, chat_id)
+        for oid in old_msg_lists.get(str(chat_id), []):
+            sender.unpin(oid)
+        sender.close()
+    if CARD.encoder.stats: log.info('encode: %s', CARD.encoder)  # Empty when cards were rendered in other processes
+    images.COVERS.prune()
+    CARD.cache.prune()
 
 if __name__ == '__main__':
-    Task()
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument('-j', '--workers', type=int, default=1, help='render cards in this many processes')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='concurrent requests to AniList and bgm.tv')
+    parser.add_argument('--fetch-rate', type=float, default=5.0, help='requests a second to each of AniList and bgm.tv')
+    parser.add_argument('--fast-covers', action='store_true', help='draft-mode decode and reduced-resolution blur for covers')
+    Encoder.add_arguments(parser)
+    parser.add_argument('--jobs', help='JSON list of channels to push to, each with its own window and filters, see Job.parse')
+    parser.add_argument('--metrics', help='write Prometheus metrics to this file after the run')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this local port during the run')
+    args = parser.parse_args()
+    images.COVERS.fast = args.fast_covers
+    CARD.encoder = Encoder.from_args(args)
+    if args.metrics_port: METRICS.serve(args.metrics_port)
+    with METRICS.run('anime', args.metrics):
+        Task(args.workers, args.jobs and Jobs(args.jobs), args.fetch_workers, args.fetch_rate)
@@ -0,0 +1,881 @@
+"""本地基准测试, 不访问外部网络 (suite --record 除外)
+
+python bench.py fetch --shows 60 --latency 0.05
+python bench.py covers
+python bench.py render --workers 4
+python bench.py cards
+python bench.py push
+python bench.py telegram --shows 40
+python bench.py wrap
+python bench.py thumbs
+python bench.py encode
+python bench.py startup
+python bench.py suite --fixtures fixtures --record  # Once, with network
+python bench.py suite --fixtures fixtures --json before.json
+python bench.py compare before.json after.json
+"""
+from argparse import ArgumentParser
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import cache
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib.util import find_spec
+from io import BytesIO
+from itertools import accumulate
+from math import ceil
+from random import random
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from types import SimpleNamespace
+from urllib.parse import parse_qs, unquote, urlsplit
+import cProfile
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import jieba
+import PIL.Image
+import telebot
+from more_itertools import chunked
+from PIL.ImageChops import difference
+from PIL.ImageDraw import Draw
+from PIL.ImageStat import Stat
+from requests import ConnectionError, Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import anime
+import comics
+import daemon
+import fonts
+import images
+import layout
+import net
+import segment
+from cache import Cache
+from metrics import METRICS
+from send import Sender
+from template import Encoder, Renders
+
+
+class Mock(BaseHTTPRequestHandler):
+    """模拟 AniList, bgm.tv, 动漫之家和封面 CDN"""
+    latency = 0.05
+    shows = 60
+    comics = 20
+    per_page = 50
+    requests = 0
+    payload = 0  # Bytes of API responses
+    fail = 0.0  # Share of API requests answered with a 503
+    broken = ()  # Comic ids whose details are missing
+    first = None  # time.time() of the first request
+    base = ''
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, headers={'Content-Type': 'application/json'}) -> None:
+        Mock.requests += 1
+        Mock.first = Mock.first or time.time()
+        time.sleep(self.latency)
+        if not isinstance(body, bytes): body = json.dumps(body).encode()
+        if headers.get('Content-Type') == 'application/json': Mock.payload += len(body)
+        self.send_response(status)
+        for k, v in headers.items(): self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if random() < self.fail: return self.reply({}, 503)
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if 'ids' in body['variables']:  # Filters as in the query
+            media = [m for m in map(Media, body['variables']['ids']) if m['countryOfOrigin'] == 'JP' and m['type'] == 'ANIME' and m['format'] in ['TV', 'MOVIE', 'TV_SHORT', 'ONA'] and 'Hentai' not in m['genres']]
+            return self.reply({'data': {'Page': {'media': media}}})
+        page = body['variables']['page']
+        last = -(-self.shows // self.per_page)
+        start = int(body['variables'].get('greater', time.time())) + 1  # Every window gets its own shows
+        schedules = [Schedule(i, start) for i in range((page - 1) * self.per_page, min(page * self.per_page, self.shows))]
+        if 'description' not in body['query']:  # Only what was asked for
+            for s in schedules: del s['media']
+        self.reply({'data': {'Page': {
+            'pageInfo': {'hasNextPage': page < last, 'lastPage': last, 'total': self.shows},
+            'airingSchedules': schedules,
+        }}})
+
+    def do_GET(self):
+        if random() < self.fail and not self.path.startswith('/cover/'): return self.reply({}, 503)
+        if self.path.startswith('/cover/'):
+            i = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+            etag = f'"{i}"'
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(b'', 304, {'ETag': etag})
+            return self.reply(Cover(i), headers={'Content-Type': 'image/jpeg', 'ETag': etag})
+        if self.path.startswith('/rank/'):  # /rank/type-tag-period-page.json, comics entries a page
+            page = int(self.path.rsplit('-', 1)[-1].split('.')[0])
+            return self.reply([{'id': i} for i in range(page * self.comics, (page + 1) * self.comics)])
+        if self.path.startswith('/dynamic/comicinfo/'):
+            i = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+            if i in self.broken: return self.reply({'data': {}})
+            return self.reply({'data': {'info': Comic(i)}})
+        if self.path.startswith('/v0/subjects/'):
+            return self.reply({'id': int(self.path.rsplit('/', 1)[-1]), 'rating': {'score': 7.2}})
+        title = unquote(urlsplit(self.path).path.rsplit('/', 1)[-1])
+        i = int(title.rsplit(' ', 1)[-1])
+        self.reply({'list': [{'id': 1000 + i, 'name_cn': f'番剧 {i}', 'summary': '这是一段用于测试的简介。' * 8, 'rating': {'score': 7.1}}]})
+
+
+@cache
+def Cover(i: int) -> bytes:
+    image = PIL.Image.linear_gradient('L').resize((460, 650)).convert('RGB')
+    image = PIL.Image.merge('RGB', (image.getchannel(0), image.rotate(90 * (i % 4)).getchannel(1), PIL.Image.new('L', image.size, 37 * i % 256)))
+    file = BytesIO()
+    image.resize((1000, 1414)).save(file, 'JPEG', quality=90)
+    return file.getvalue()
+
+
+def Media(i: int) -> dict:
+    return {
+        'id': i,
+        'title': {'native': f'アニメ {i}', 'romaji': f'Anime {i}'},
+        'coverImage': {'extraLarge': f'{Mock.base}/cover/{i}.jpg', 'color': '#73B9DF'},
+        'episodes': 12,
+        'type': 'ANIME',
+        'countryOfOrigin': i % 10 == 7 and 'CN' or 'JP',  # Filtered out
+        'format': i % 5 == 3 and 'MOVIE' or 'TV',
+        'source': 'MANGA',
+        'duration': 24,
+        'genres': ['Action', i % 3 and 'Comedy' or 'Drama'],
+        'studios': {'nodes': [{'name': 'Studio', 'isAnimationStudio': True}]},
+        'description': 'A show used for benchmarking.',
+    }
+
+
+def Schedule(i: int, start: int) -> dict:
+    m = i % 10 == 4 and i - 1 or i  # Two episodes of the same show at once
+    return {
+        'episode': 1 + i % 12,
+        'airingAt': start + m * 60,
+        'mediaId': m,
+        'media': Media(m),
+    }
+
+
+def Comic(i: int) -> dict:
+    return {
+        'title': f'漫画 {i}',
+        'subtitle': i % 2 and f'マンガ {i}' or '',
+        'description': '这是一段用于测试的漫画简介, 包含一些中文标点和 English words。' * 4,
+        'last_update_chapter_name': f'第{i + 10}话',
+        'types': '冒险/欢乐向/校园',
+        'authors': '作者A/作者B',
+        'cover': f'{Mock.base}/cover/{i}.jpg',
+    }
+
+
+class Bot:
+    """假的 Telegram Bot, 只记录发送时间"""
+
+    def __init__(self, latency: float = 0.5):
+        self.latency = latency
+        self.sent = []
+
+    def send_media_group(self, chat_id, media):
+        time.sleep(self.latency)
+        self.sent.append(time.perf_counter())
+        return [SimpleNamespace(message_id=len(self.sent))]
+
+    def pin_chat_message(self, chat_id, message_id, disable_notification=None):
+        return True
+
+
+class Telegram(BaseHTTPRequestHandler):
+    """模拟 Telegram Bot API: 每个 chat 在 window 秒内最多 limit 条消息, 超出时返回 429"""
+    latency = 0.2
+    limit = 20
+    window = 60.0
+    lock = Lock()
+    sent = []  # time.monotonic() of each accepted message
+    throttles = 0
+    calls = []  # (time.monotonic(), method) of each accepted call
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body) -> None:
+        body = json.dumps(body).encode()
+        self.send_response(200 if body.startswith(b'{"ok": true') else 429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))  # Photos, not looked at
+        time.sleep(self.latency)
+        n = len(json.loads(parse_qs(url.query)['media'][0])) if method == 'sendMediaGroup' else 0
+        with Telegram.lock:
+            now = time.monotonic()
+            sent = Telegram.sent = [t for t in Telegram.sent if t > now - self.window]
+            if len(sent) + n > self.limit:
+                Telegram.throttles += 1
+                retry = ceil(sent[len(sent) + n - self.limit - 1] + self.window - now)
+                return self.reply({'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry}', 'parameters': {'retry_after': retry}})
+            sent.extend([now] * n)
+            Telegram.calls.append((now, method))
+            first = len(Telegram.calls) * 100
+        if n:
+            return self.reply({'ok': True, 'result': [{'message_id': first + i, 'date': int(time.time()), 'chat': {'id': 0, 'type': 'supergroup'}} for i in range(n)]})
+        self.reply({'ok': True, 'result': True})
+
+
+def Serve(handler=Mock) -> str:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    handler.base = f'http://127.0.0.1:{server.server_port}'
+    return handler.base
+
+
+def Upstream(**mock) -> str:
+    """起一个 Mock, 参数设为 mock, 番剧和漫画的上游都指向它"""
+    for k, v in mock.items(): setattr(Mock, k, v)
+    anime.ANILIST = anime.BGM = comics.RANK = comics.DMZJ = Serve()
+    return anime.ANILIST
+
+
+@contextmanager
+def Caches():
+    """换上临时目录里的空缓存: 番剧详情, bgm.tv, 分词, 封面和卡片; 退出时换回并删掉, Mock 的 URL 不会留在 cache/ 里"""
+    saved = anime.SUBJECTS, anime.MEDIA, segment.SEGMENTS, images.COVERS, anime.CARD.cache, comics.CARD.cache
+    with TemporaryDirectory() as tmp:
+        anime.SUBJECTS = Cache(f'{tmp}/subjects.db')
+        anime.MEDIA = Cache(f'{tmp}/media.db')
+        segment.SEGMENTS = Cache(f'{tmp}/segments.db')
+        images.COVERS = images.Images(f'{tmp}/images', fast=images.COVERS.fast)
+        anime.CARD.cache = Renders(f'{tmp}/cards/anime')
+        comics.CARD.cache = Renders(f'{tmp}/cards/comics')
+        try:
+            yield tmp
+        finally:
+            anime.SUBJECTS, anime.MEDIA, segment.SEGMENTS, images.COVERS, anime.CARD.cache, comics.CARD.cache = saved
+
+
+def Cold(fn, *args):
+    """在空缓存上跑 fn"""
+    with Caches():
+        return fn(*args)
+
+
+def Timed(fn, *args, **kwargs) -> tuple:
+    t = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return time.perf_counter() - t, out
+
+
+def BenchComics(args) -> None:
+    """排行榜逐个取详情和并发取详情; 有 --broken 时那几个条目的详情是坏的"""
+    Upstream(latency=args.latency, comics=args.comics, fail=args.fail, broken=set(args.broken))
+    net.HTTP.backoff = 0.05
+    categories = [f'2-{tag}-0' for tag in range(args.categories)]
+    for workers in 1, args.workers:
+        Mock.requests = 0
+        t, out = Timed(Cold, comics.Fetch, categories, args.pages, workers, args.rate)
+        skipped = sorted(set(range(args.comics * args.pages)) - {c['id'] for c in out})
+        assert all(c['ranking'] == c['id'] + 1 for c in out), 'rankings moved'
+        print(f'comics workers={workers:<3}{t:8.3f}s  {len(out)} comics, {Mock.requests} requests, skipped {skipped}')
+    h = METRICS.histogram('span_seconds')[(('span', 'dmzj_item'),)]
+    print(f'dmzj_item  {h["count"]} items, mean {h["sum"] / h["count"] * 1e3:.0f} ms')
+
+
+def BenchFetch(args) -> None:
+    Upstream(latency=args.latency, shows=args.shows, fail=args.fail)
+    net.HTTP.backoff = 0.05
+    start = datetime.now()
+    Mock.requests = Mock.payload = 0
+    serial, a = Timed(Cold, anime.Fetch, start, start + timedelta(1), 1, 0)
+    print(f'fetch serial     {serial:8.3f}s  {len(a)} shows, {Mock.requests} requests, {Mock.payload / 1024:.0f} KiB')
+    parallel, b = Timed(anime.Fetch, start, start + timedelta(1), workers=args.workers, rate=args.rate)
+    assert [s.id for s in a] == [s.id for s in b]
+    print(f'fetch workers={args.workers:<3}{parallel:8.3f}s  x{serial / parallel:.1f}')
+    Mock.requests = Mock.payload = 0
+    warm, c = Timed(anime.Fetch, start, start + timedelta(1), workers=args.workers, rate=args.rate)
+    assert b == c
+    print(f'fetch warm cache {warm:8.3f}s  {Mock.requests} requests, {Mock.payload / 1024:.0f} KiB, {anime.SUBJECTS}, {anime.MEDIA}')
+    for host, h in net.HTTP.histograms().items():
+        buckets = '  '.join(f'<={le}s:{n}' for le, n in h['buckets'].items())
+        print(f'{host}  {h["count"]} requests, {h["errors"]} errors, mean {h["sum"] / h["count"]:.3f}s  {buckets}')
+
+
+def BenchCovers(args) -> None:
+    Upstream(latency=args.latency, shows=args.shows)
+    anime.CARD.cache = None
+    start = datetime.now()
+    info = anime.Fetch(start, start + timedelta(1))
+    for run in ('cold', 'warm'):
+        images.COVERS.clear()
+        Mock.requests = 0
+        t, cards = Timed(anime.Card, info)
+        print(f'card {run}  {t:8.3f}s  {Mock.requests} cover requests, {sum(len(c[0]) for c in cards) / 2 ** 20:.1f} MiB')
+
+
+def BenchRender(args) -> None:
+    Upstream(latency=0, shows=args.shows)
+    anime.CARD.cache = None
+    start = datetime.now()
+    info = anime.Fetch(start, start + timedelta(1))
+    expect = anime.Card(info)  # Warms the cover cache
+    for workers in range(1, args.workers + 1):
+        t, cards = Timed(anime.Card, info, workers)
+        assert cards == expect
+        if workers == 1: base = t
+        print(f'render workers={workers:<3}{t:8.3f}s  {len(info) / t:6.1f} cards/s  x{base / t:.1f}')
+
+
+def BenchCards(args) -> None:
+    Upstream(latency=0, shows=args.shows)
+    start = datetime.now()
+    info = anime.Fetch(start, start + timedelta(1))
+    cache, anime.CARD.cache = anime.CARD.cache, None
+    anime.Card(info)  # Warms the cover cache
+    t, expect = Timed(anime.Card, info)
+    print(f'cards uncached  {t:8.3f}s')
+    anime.CARD.cache = cache
+    for run in ('cold', 'same', 'head'):
+        if run == 'head':  # Next week: only the airing time changes
+            for s in info: s.airingAt += 7 * 86400
+            anime.CARD.cache = None
+            expect = anime.Card(info)
+            anime.CARD.cache = cache
+        before = cache.hits, cache.patched, cache.misses
+        t, cards = Timed(anime.Card, info)
+        assert cards == expect
+        hits, patched, misses = (n - m for n, m in zip((cache.hits, cache.patched, cache.misses), before))
+        print(f'cards {run:<9}{t:8.3f}s  {hits} hits, {patched} patched, {misses} misses')
+
+
+def BenchPush(args) -> None:
+    Upstream(latency=args.latency, shows=args.shows)
+    anime.CARD.cache = None
+    segment.Tokenizer()  # Building the dictionary under tracemalloc would dwarf everything else
+    start = datetime.now()
+
+    def Materialized(sender):
+        cards = anime.Card(anime.Fetch(start, start + timedelta(1)), args.workers)
+        return anime.Push(sender, cards, ceil(len(cards) / 10), '')
+
+    def Streaming(sender):
+        info = anime.Schedules(start, start + timedelta(1))
+        cards = anime.Imap(anime.Render, anime.Enrich(info), args.workers, anime.CARD.load)
+        return anime.Push(sender, cards, ceil(len(info) / 10), '')
+
+    for name, fn in (('materialized', Materialized), ('streaming', Streaming)):
+        bot = Bot(args.send)
+        tracemalloc.start()
+        t, _ = Timed(Cold, fn, Sender(bot, 0, rate=1e9))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        first = bot.sent[0] - (bot.sent[-1] - t)
+        _, growth = Cold(PeakRss, lambda: fn(Sender(Bot(0), 0, rate=1e9)))  # Again, without tracemalloc
+        rss = growth is not None and f'{growth / 2 ** 20:6.1f} MiB' or '-'
+        print(f'push {name:<13}{t:8.3f}s  first post {first:6.3f}s  alloc peak {peak / 2 ** 20:6.1f} MiB  rss growth {rss}')
+
+
+def BenchBatch(args) -> None:
+    """几个频道各跑一次, 和一次批量做完比较; 卡片不走渲染缓存, 数得出渲染了几次"""
+    Upstream(latency=args.latency, shows=args.shows)
+    anime.CARD.cache = None
+    segment.Tokenizer()
+    start = datetime.now().replace(hour=17, minute=0, second=0, microsecond=0)
+    jobs = [
+        anime.Job(1, start),
+        anime.Job(2, start, formats=['TV']),
+        anime.Job(3, start, exclude=['Comedy']),
+        anime.Job(4, start, 7, '本周放送番剧'),
+    ]
+    anime.Batch(Bot(0), jobs, args.workers, 1e9)  # Warms the caches, as on any day after the first
+
+    rendered = 0
+    Imap = anime.Imap
+
+    def Counted(fn, *args, **kwargs):  # Cards come back to the parent whatever --workers is; spans of the workers do not
+        nonlocal rendered
+        for out in Imap(fn, *args, **kwargs):
+            rendered += fn is anime.Render
+            yield out
+
+    def Separate():
+        for job in jobs:
+            anime.Batch(Bot(0), [job], args.workers, 1e9)
+
+    anime.Imap = Counted
+    try:
+        for name, fn in ('separate', Separate), ('batch', lambda: anime.Batch(Bot(0), jobs, args.workers, 1e9)):
+            Mock.requests = rendered = 0
+            t, _ = Timed(fn)
+            print(f'{name:<9}{t:8.3f}s  {Mock.requests} requests, {rendered} cards rendered')
+    finally:
+        anime.Imap = Imap
+
+
+def BenchTelegram(args) -> None:
+    """时间按 scale 缩小: 默认 6 秒当 1 分钟"""
+    Telegram.latency = args.latency
+    Telegram.limit = args.limit
+    Telegram.window = 60 * args.scale
+    telebot.apihelper.API_URL = Serve(Telegram) + '/bot{0}/{1}'
+    bot = telebot.TeleBot('0:token')
+    file = BytesIO()
+    PIL.Image.new('RGB', (8, 8)).save(file, 'PNG')
+    cards = [(file.getvalue(), SimpleNamespace(bgm_id=i, native=f'番剧 {i}')) for i in range(args.shows)]
+    total = ceil(len(cards) / 10)
+    old = list(range(total))
+
+    def Fixed():
+        """原来的做法: 每组之后固定等 60 秒, 最后串行置顶和取消置顶"""
+        msg_list = []
+        for chunk in chunked(cards, 10):
+            msg = bot.send_media_group(0, [telebot.types.InputMediaPhoto(p[0]) for p in chunk])
+            msg_list.append(msg[0].message_id)
+            if total > 1: time.sleep(60 * args.scale)
+        for id in msg_list:
+            bot.pin_chat_message(0, id, disable_notification=True)
+        for oid in old:
+            bot.unpin_chat_message(0, oid)
+
+    def Adaptive(rate, burst):
+        def Run():
+            sender = Sender(bot, 0, rate, burst)
+            anime.Push(sender, cards, total, '')
+            for oid in old:
+                sender.unpin(oid)
+            sender.close()
+            return sender
+        return Run
+
+    for name, fn in (('fixed', Fixed), ('retry-only', Adaptive(1e9, 1e9)), ('bucket', Adaptive(args.limit / Telegram.window, args.limit))):
+        time.sleep(Telegram.window)  # Start each run with an empty window
+        Telegram.throttles = 0
+        Telegram.calls = []
+        t, _ = Timed(fn)
+        print(f'telegram {name:<11}{t:8.3f}s  {Telegram.throttles} throttles, {len(Telegram.calls)} calls')
+
+
+def Reference(text, width, font, line=-1, no_space=False):
+    """原来逐词调用 getlength 的 Wrap"""
+    space = font.getlength(' ')
+    dots = font.getlength('[...]')
+    words = text.split()
+    lens = tuple(accumulate(map(space.__add__, map(font.getlength, words))))
+    out = []
+    w = width + space
+    while line and words:
+        i = bisect_left(lens, w)
+        if line == 1:
+            for j in reversed(range(i)):
+                dots -= lens[j]
+                if dots > 0:
+                    words[j] = ''
+                else:
+                    words[j] = '[...]'
+                    break
+        out.append(('' if no_space else ' ').join(words[:i]))
+        w = width + lens[i - 1] + space
+        words = words[i:]
+        lens = lens[i:]
+        line -= 1
+    return out
+
+
+def BenchFonts(args) -> None:
+    """字体和后备链的加载, 码位索引, 以及按字体分段的开销"""
+    t, _ = Timed(lambda: [fonts.Cmap(path, index) for path, index in fonts.FALLBACK if Path(path).exists()])
+    print(f'cmap      {t * 1e3:8.1f}ms  {", ".join(path for path, _ in fonts.FALLBACK if Path(path).exists())}')
+    t, _ = Timed(lambda: (anime.CARD.load(), comics.CARD.load()))
+    print(f'load      {t * 1e3:8.1f}ms  {len(anime.CARD.fonts) + len(comics.CARD.fonts)} faces with fallbacks')
+    font = anime.CARD.fonts['1']
+    texts = [f'{i} ★ 第{i}话 テスト ♪ Title {i}' for i in range(args.texts)]
+    for run in 'cold', 'cached':
+        if run == 'cold':
+            fonts.Runs.cache_clear()
+            font.picks.clear()
+        t, out = Timed(lambda: [fonts.Runs(font, text) for text in texts])
+        print(f'runs {run:<7}{t / len(texts) * 1e6:8.2f}us a text  {sum(map(len, out)) / len(out):.1f} runs')
+    t, _ = Timed(lambda: [fonts.Runs(font, f'Plain ASCII title {i}') for i in range(args.texts)])
+    print(f'runs ascii  {t / args.texts * 1e6:8.2f}us a text')
+
+
+def BenchWrap(args) -> None:
+    font = anime.CARD.fonts['1']
+    texts = [' '.join(jieba.cut(f'第{i}话。主人公在学校里遇到了神秘的转学生，两人一起卷入了一场意想不到的冒险。' * 3)) for i in range(args.cards)]
+    texts += [f'Episode {i} of a show whose description is long enough to need several lines of wrapping text.' for i in range(args.cards)]
+    for text in texts:
+        for line in (-1, 7):
+            assert layout.Wrap(text, 500, font, line, True) == Reference(text, 500, font, line, True)
+    for name, fn in (('getlength', Reference), ('layout', layout.Wrap)):
+        layout._Wrap.cache_clear()
+        t, _ = Timed(lambda: [fn(text, 500, font, 7, True) for _ in range(args.repeat) for text in texts])
+        print(f'wrap {name:<10}{t / args.repeat / len(texts) * 1e6:8.1f}us per call')
+    layout.widths.clear()
+    t, _ = Timed(lambda: [layout.Wrap(text + ' x', 500, font, 7, True) for text in texts])
+    print(f'wrap {"cold cache":<10}{t / len(texts) * 1e6:8.1f}us per call')
+
+
+def BenchThumbs(args) -> None:
+    covers = [Cover(i) for i in range(args.covers)]
+    for name, fn in (('panels', images.Panels), ('fast', images.FastPanels)):
+        t, _ = Timed(lambda: [fn(raw) for raw in covers])
+        print(f'thumbs {name:<7}{t / len(covers) * 1e3:8.1f}ms per card')
+    worst = {}
+    for raw in covers:
+        for part, a, b in zip(('thumb', 'panel'), images.Panels(raw), images.FastPanels(raw)):
+            stat = Stat(difference(a, b))
+            worst[part] = max(worst.get(part, (0, 0)), (max(stat.mean), max(stat.rms)))
+    for part, (mean, rms) in worst.items():
+        print(f'thumbs diff {part:<6}mean {mean:5.2f}  rms {rms:5.2f}  (0-255, worst channel and cover)')
+    for part, (_, rms) in worst.items():
+        assert rms <= args.max_rms, f'FastPanels {part} is {rms:.2f} rms off Panels, more than {args.max_rms}'
+
+
+def BenchEncode(args) -> None:
+    Upstream(latency=0, shows=args.shows)
+    start = datetime.now()
+    cards = []
+    for data in anime.Fetch(start, start + timedelta(1)):
+        cards.append(anime.Body(data))
+        anime.Head(data, Draw(cards[-1]))
+    for encoder in (Encoder(), Encoder(level=1), Encoder(optimize=True), Encoder(colors=256), Encoder('jpeg'), Encoder('webp'),
+                    Encoder('auto'), Encoder('auto', budget=args.budget * 1024)):
+        t, out = Timed(lambda: [encoder(card) for card in cards])
+        worst = 0
+        for card, data in zip(cards, out):
+            worst = max(worst, max(Stat(difference(card, PIL.Image.open(BytesIO(data)).convert('RGB'))).rms))
+        print(f'encode {encoder!r:<95}{sum(map(len, out)) / len(out) / 1024:6.0f} KiB {t / len(out) * 1e3:6.1f}ms  rms {worst:5.2f}')
+        print(f'       {encoder}')
+
+
+def BenchStartup(args) -> None:
+    base = Upstream(latency=0, shows=args.shows)
+    with Caches() as tmp:  # The subprocesses use the same files
+        code = f'''if True:
+            from datetime import datetime, timedelta
+            import anime, images, segment
+            from cache import Cache
+            anime.ANILIST = anime.BGM = {base!r}
+            anime.SUBJECTS = Cache({tmp!r} + '/subjects.db')
+            anime.MEDIA = Cache({tmp!r} + '/media.db')
+            segment.SEGMENTS = Cache({tmp!r} + '/segments.db')
+            segment.DICT_CACHE = {tmp!r} + '/jieba.cache'
+            anime.Fetch(datetime.now(), datetime.now() + timedelta(1))
+        '''
+        for run in ('cold', 'warm'):  # Warm reuses the dictionary, subject and segment caches
+            Mock.first = None
+            t = time.time()
+            subprocess.run([sys.executable, '-c', code], check=True, stderr=subprocess.DEVNULL)
+            print(f'startup {run}  first request {Mock.first - t:6.3f}s  total {time.time() - t:6.3f}s')
+        segment.DICT_CACHE = f'{tmp}/jieba.cache'  # The next run in a daemon, with the same caches
+        daemon.Warm()
+        Mock.first = None
+        t = time.time()
+        anime.Fetch(datetime.now(), datetime.now() + timedelta(1))
+        print(f'startup daemon  first request {Mock.first - t:6.3f}s  total {time.time() - t:6.3f}s')
+
+
+class Fixtures(HTTPAdapter):
+    """录下或回放 HTTP 响应, 按方法, URL 和请求体存在 root 下; 回放时不联网, 没录过的请求直接失败"""
+
+    def __init__(self, root: str, record=False):
+        super().__init__()
+        self.root = Path(root)
+        self.record = record
+
+    def send(self, request, **kwargs) -> Response:
+        body = request.body or b''
+        if isinstance(body, str): body = body.encode()
+        key = self.root / sha1(f'{request.method} {request.url}\n'.encode() + body).hexdigest()
+        if self.record:
+            r = super().send(request, **kwargs)
+            self.root.mkdir(parents=True, exist_ok=True)
+            headers = {k: v for k, v in r.headers.items() if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+            key.with_suffix('.body').write_bytes(r.content)
+            key.with_suffix('.json').write_text(json.dumps({'method': request.method, 'url': request.url, 'status': r.status_code, 'headers': headers}))
+            return r
+        try:
+            meta = json.loads(key.with_suffix('.json').read_text())
+        except FileNotFoundError:
+            raise ConnectionError(f'no fixture for {request.method} {request.url}', request=request) from None
+        r = Response()
+        r.status_code = meta['status']
+        r.headers = CaseInsensitiveDict(meta['headers'])
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = key.with_suffix('.body').read_bytes()
+        r.url = request.url
+        r.request = request
+        return r
+
+
+def PeakRss(fn) -> tuple[int, int] | tuple[None, None]:
+    """在 fork 出来的子进程里跑一次 fn, 返回期间的最高常驻内存和比开始时多出的部分, 字节
+
+    每次都从 fork 时的堆开始, 不会用上之前释放的内存; 峰值靠 /proc/self/clear_refs 清零, 只在 Linux 上有
+    PIL 的图像缓冲区 tracemalloc 看不到, 这里看得到
+    """
+    return Forked(lambda: Peak(fn))
+
+
+def Forked(fn):
+    """fn() 在子进程里的返回值"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            with open(w, 'wb') as f:
+                pickle.dump(fn(), f)
+        except BaseException:
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(0)
+    os.close(w)
+    with open(r, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data: raise RuntimeError('child failed')
+    return pickle.loads(data)
+
+
+def Peak(fn) -> tuple[int, int] | tuple[None, None]:
+    def Status() -> dict[str, int]:
+        with open('/proc/self/status') as f:
+            return {k: int(v.split()[0]) * 1024 for k, v in (line.split(':', 1) for line in f) if k in ('VmRSS', 'VmHWM')}
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')  # Resets VmHWM to the current RSS
+    except OSError:
+        return None, None
+    start = Status()['VmRSS']
+    fn()
+    peak = Status()['VmHWM']
+    return peak, peak - start
+
+
+def Measure(fn, repeat: int) -> dict:
+    """跑 repeat 次计时, 在 tracemalloc 下跑一次看分配, 再跑一次看常驻内存"""
+    seconds = [Timed(fn)[0] for _ in range(repeat)]
+    tracemalloc.start()
+    fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss, growth = PeakRss(fn)
+    return {'seconds': seconds, 'best': min(seconds), 'median': median(seconds), 'peak': peak, 'retained': retained,
+            'rss_peak': rss, 'rss_growth': growth}
+
+
+def Profile(fn, root: Path, name: str, profiler: str) -> None:
+    root.mkdir(parents=True, exist_ok=True)
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        p = Profiler()
+        p.start()
+        fn()
+        p.stop()
+        (root / f'{name}.html').write_text(p.output_html())
+    else:
+        p = cProfile.Profile()
+        p.runcall(fn)
+        p.dump_stats(root / f'{name}.prof')
+
+
+def BenchSuite(args) -> None:
+    """整条流水线分阶段计时; 有 --fixtures 时回放录下的真实响应, 否则用 Mock"""
+    if args.profiler == 'pyinstrument' and not find_spec('pyinstrument'):
+        sys.exit('pyinstrument is not installed')
+    if args.fixtures:
+        adapter = Fixtures(args.fixtures, args.record)
+        net.HTTP.session.mount('http://', adapter)
+        net.HTTP.session.mount('https://', adapter)
+        saved = Path(args.fixtures) / 'start'
+        if args.record:
+            saved.parent.mkdir(parents=True, exist_ok=True)
+            saved.write_text(args.start or datetime.now().replace(hour=17, minute=0, second=0, microsecond=0).isoformat())
+        start = datetime.fromisoformat(args.start or saved.read_text())  # The AniList query has the time range in it
+    else:
+        Upstream(latency=0, shows=args.shows, comics=args.comics)
+        start = datetime.fromisoformat(args.start) if args.start else datetime.now().replace(hour=17, minute=0, second=0, microsecond=0)
+    anime.CARD.cache = comics.CARD.cache = None
+    segment.Tokenizer()  # Loaded once, as in a long running process
+    rate = args.rate if args.rate is not None else 5.0 if args.record else 0  # Polite to the real bgm.tv, no sleeping on replays
+
+    # Inputs for the later stages
+    info = anime.Fetch(start, start + timedelta(1), args.workers, rate)
+    ranks = comics.Fetch(rate=rate)
+    raws = [images.COVERS.get(s.cover) for s in info]
+    covers = [images.Decode(raw) for raw in raws]
+    font = anime.CARD.fonts['1']
+    xl, _, xr, _ = anime.CARD.regions['text']
+
+    def Wrap():
+        layout._Wrap.cache_clear()
+        return [layout.Wrap(s.description, xr - xl, font, no_space=s.no_space) for s in info]
+
+    def Text():
+        out = []
+        for data in info:
+            out.append(anime.Body(data))
+            anime.Head(data, Draw(out[-1]))
+        return out
+
+    def Card():
+        images.COVERS.clear()  # Covers and panels from disk, as on the next day
+        return anime.Card(info)
+
+    def Push():
+        sender = Sender(Bot(0), 0, rate=1e9)
+        anime.Push(sender, cards, ceil(len(cards) / 10), '')
+        sender.close()
+
+    rendered = Text()
+    cards = anime.Card(info)
+    stages = {
+        'fetch.anime': lambda: Cold(anime.Fetch, start, start + timedelta(1), args.workers, rate),
+        'fetch.comics': lambda: Cold(comics.Fetch, comics.CATEGORIES, 1, args.workers, rate),
+        'wrap': Wrap,
+        'card.decode': lambda: [images.Decode(raw) for raw in raws],
+        'card.thumb': lambda: [images.Thumb(image) for image in covers],
+        'card.blur': lambda: [images.Blur(image) for image in covers],
+        'card.text': Text,
+        'card.encode': lambda: [anime.CARD.encoder(image) for image in rendered],
+        'card.anime': Card,
+        'card.comics': lambda: comics.Card(ranks),
+        'push': Push,
+    }
+    print(f'{len(info)} shows, {len(ranks)} comics, {args.fixtures or "mock"}')
+    results = {}
+    for name, fn in stages.items():
+        if args.stage and not any(name.startswith(prefix) for prefix in args.stage): continue
+        r = results[name] = Measure(fn, args.repeat)
+        rss = r['rss_peak'] is not None and f'rss peak {r["rss_peak"] / 2 ** 20:6.0f} MiB (+{r["rss_growth"] / 2 ** 20:.0f})' or 'rss peak -'
+        print(f'{name:<14}best {r["best"] * 1e3:9.2f}ms  median {r["median"] * 1e3:9.2f}ms  alloc peak {r["peak"] / 2 ** 20:7.1f} MiB  '
+              f'retained {r["retained"] / 2 ** 20:6.1f} MiB  {rss}')
+        if args.profile: Profile(fn, Path(args.profile), name, args.profiler)
+    if args.json:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+        report = {'commit': commit, 'python': sys.version.split()[0], 'time': datetime.now().isoformat(timespec='seconds'),
+                  'fixtures': args.fixtures or 'mock', 'shows': len(info), 'comics': len(ranks), 'stages': results}
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+def BenchCompare(args) -> None:
+    """对比两次 suite 的 JSON, 中位数慢了超过 threshold 的阶段以非零退出"""
+    old, new = (json.loads(Path(path).read_text()) for path in (args.old, args.new))
+    print(f'{old["commit"]} -> {new["commit"]}')
+    slower = []
+    for name, b in new['stages'].items():
+        if name not in old['stages']: continue
+        a = old['stages'][name]
+        ratio = b['median'] / a['median']
+        alloc = b['peak'] / a['peak'] if a['peak'] else 1
+        if ratio > 1 + args.threshold: slower.append(name)
+        print(f'{name:<14}{a["median"]:8.3f}s -> {b["median"]:8.3f}s  x{ratio:5.2f}  alloc peak x{alloc:5.2f}{"  SLOWER" * (name in slower)}')
+    if slower: sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    sub = parser.add_subparsers(required=True)
+    p = sub.add_parser('fetch')
+    p.add_argument('--shows', type=int, default=60)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--rate', type=float, default=0)
+    p.add_argument('--fail', type=float, default=0, help='share of API requests that get a 503')
+    p.set_defaults(run=BenchFetch)
+    p = sub.add_parser('comics', help='ranking details one by one and concurrently')
+    p.add_argument('--comics', type=int, default=20, help='entries a ranking page')
+    p.add_argument('--pages', type=int, default=1)
+    p.add_argument('--categories', type=int, default=1)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--rate', type=float, default=0)
+    p.add_argument('--fail', type=float, default=0, help='share of API requests that get a 503')
+    p.add_argument('--broken', type=int, nargs='*', default=[], help='comic ids whose details are missing')
+    p.set_defaults(run=BenchComics)
+    p = sub.add_parser('covers')
+    p.add_argument('--shows', type=int, default=20)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.set_defaults(run=BenchCovers)
+    p = sub.add_parser('render')
+    p.add_argument('--shows', type=int, default=40)
+    p.add_argument('--workers', type=int, default=os.cpu_count())
+    p.set_defaults(run=BenchRender)
+    p = sub.add_parser('cards')
+    p.add_argument('--shows', type=int, default=40)
+    p.set_defaults(run=BenchCards)
+    p = sub.add_parser('push')
+    p.add_argument('--shows', type=int, default=40)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.add_argument('--send', type=float, default=0.5, help='seconds per send_media_group')
+    p.add_argument('--workers', type=int, default=1)
+    p.set_defaults(run=BenchPush)
+    p = sub.add_parser('batch', help='several channels one by one and in one batch')
+    p.add_argument('--shows', type=int, default=40)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.add_argument('--workers', type=int, default=1)
+    p.set_defaults(run=BenchBatch)
+    p = sub.add_parser('telegram')
+    p.add_argument('--shows', type=int, default=40)
+    p.add_argument('--latency', type=float, default=0.2, help='seconds per Bot API call')
+    p.add_argument('--limit', type=int, default=20, help='messages per minute in the group')
+    p.add_argument('--scale', type=float, default=0.1, help='length of a simulated minute, in minutes')
+    p.set_defaults(run=BenchTelegram)
+    p = sub.add_parser('fonts', help='font loading, coverage index and run splitting')
+    p.add_argument('--texts', type=int, default=10000)
+    p.set_defaults(run=BenchFonts)
+    p = sub.add_parser('wrap')
+    p.add_argument('--cards', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(run=BenchWrap)
+    p = sub.add_parser('thumbs')
+    p.add_argument('--covers', type=int, default=20)
+    p.add_argument('--max-rms', type=float, default=2, help='fail when the fast path is further off than this, 0-255')
+    p.set_defaults(run=BenchThumbs)
+    p = sub.add_parser('encode')
+    p.add_argument('--shows', type=int, default=20)
+    p.add_argument('--budget', type=int, default=200, help='KiB, for the auto encoder')
+    p.set_defaults(run=BenchEncode)
+    p = sub.add_parser('startup')
+    p.add_argument('--shows', type=int, default=20)
+    p.set_defaults(run=BenchStartup)
+    p = sub.add_parser('suite', help='every stage of the pipeline, see BenchSuite')
+    p.add_argument('--fixtures', help='replay responses recorded in this directory instead of the mock')
+    p.add_argument('--record', action='store_true', help='with --fixtures, make real requests and record them')
+    p.add_argument('--start', help='ISO time the schedule starts at, fixed when recording')
+    p.add_argument('--shows', type=int, default=40)
+    p.add_argument('--comics', type=int, default=20)
+    p.add_argument('--workers', type=int, default=8, help='fetch threads')
+    p.add_argument('--rate', type=float, help='bgm.tv requests per second, unlimited unless recording')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--stage', action='append', help='only stages starting with this, may be repeated')
+    p.add_argument('--json', help='write the results here')
+    p.add_argument('--profile', help='write a profile of every stage into this directory')
+    p.add_argument('--profiler', choices=('cprofile', 'pyinstrument'), default='cprofile')
+    p.set_defaults(run=BenchSuite)
+    p = sub.add_parser('compare', help='two suite --json results')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1, help='share a median may grow by')
+    p.set_defaults(run=BenchCompare)
+    args = parser.parse_args()
+    with Caches():  # Nothing a bench fetches or renders lands in cache/
+        args.run(args)
@@ -0,0 +1,98 @@
+from math import inf
+from pathlib import Path
+from threading import Lock, get_ident
+import json
+import os
+import sqlite3
+import time
+
+from metrics import METRICS
+
+
+class Cache:
+    """持久化的键值缓存, 按最近使用淘汰"""
+
+    def __init__(self, path: str, size: int = 4096):
+        self.path = path
+        self.size = size
+        self.lock = Lock()
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+        os.register_at_fork(after_in_child=self.forked)  # SQLite connections must not be used across fork()
+
+    def forked(self) -> None:
+        self.lock = Lock()
+        self.db = None  # Reopened on first use in the child
+
+    def __str__(self) -> str:
+        return f'{Path(self.path).name}: {self.hits} hits, {self.misses} misses'
+
+    def open(self) -> sqlite3.Connection:
+        if self.db is None:  # Opened on first use, so importing never touches the disk
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, time REAL, used REAL)')
+        return self.db
+
+    def get(self, key: str, ttl: float = inf):
+        with self.lock:
+            db = self.open()
+            row = db.execute('SELECT value, time FROM kv WHERE key = ?', (key,)).fetchone()
+            if row is None or time.time() - row[1] > ttl:
+                self.misses += 1
+                METRICS.count('cache_requests_total', cache=Path(self.path).stem, result='miss')
+                return None
+            self.hits += 1
+            METRICS.count('cache_requests_total', cache=Path(self.path).stem, result='hit')
+            db.execute('UPDATE kv SET used = ? WHERE key = ?', (time.time(), key))
+            db.commit()
+            return json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        with self.lock:
+            db = self.open()
+            now = time.time()
+            db.execute('REPLACE INTO kv VALUES (?, ?, ?, ?)', (key, json.dumps(value, ensure_ascii=False), now, now))
+            db.execute('DELETE FROM kv WHERE key NOT IN (SELECT key FROM kv ORDER BY used DESC LIMIT ?)', (self.size,))
+            db.commit()
+
+
+class Files:
+    """按摘要存放的文件, 超过 age 秒没用过的会被清理"""
+
+    def __init__(self, root: str, age: float = 30 * 86400):
+        self.root = Path(root)
+        self.age = age
+
+    def path(self, digest: str, suffix: str = '') -> Path:
+        return self.root / digest[:2] / f'{digest}{suffix}'
+
+    def read(self, path: Path) -> bytes | None:
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # Mark as used for pruning
+        return data
+
+    def write(self, path: Path, data: bytes) -> None:
+        Write(path, data)
+
+    def prune(self) -> None:
+        if not self.root.exists(): return
+        deadline = time.time() - self.age
+        for path in self.root.glob('??/*'):
+            if path.stat().st_mtime < deadline:
+                path.unlink(missing_ok=True)
+
+
+def Write(path: str | Path, data: bytes, sync=False) -> None:
+    """先写临时文件再改名, 读到的总是完整的旧内容或新内容; sync 时落盘后再改名, 断电也不会丢"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{get_ident()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if sync: os.fsync(f.fileno())
+    tmp.replace(path)
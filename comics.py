@@ -1,244 +1,265 @@
-from bisect import bisect_left
+from argparse import ArgumentParser
+from collections import Counter
 from colorsys import hsv_to_rgb, rgb_to_hsv
 from datetime import datetime
-from io import BytesIO
-from itertools import accumulate
+from itertools import groupby
 from math import ceil
-from operator import truediv
 from re import compile
+import logging
 
-import jieba
 import PIL.Image
 import telebot
 from more_itertools import chunked
-from PIL.ImageDraw import Draw
-from PIL.ImageEnhance import Brightness
-from PIL.ImageFilter import GaussianBlur
-from PIL.ImageFont import FreeTypeFont, truetype
-from requests import get
+from PIL.ImageDraw import ImageDraw
+from PIL.ImageFont import FreeTypeFont
+from requests import RequestException
 
+from color import Dominant
+import images
+import layout
+from metrics import METRICS, Span
+from net import HTTP, Map, RateLimit
+from pool import Imap, Prefetch
+from segment import CutAll
+from send import Sender
+from fonts import Text
+from template import Encoder, Fill, Line, Stack, Tags, Template
 
-def Fetch() -> list[dict]:
-    """获取排行榜数据"""
-    r = get('https://m.dmzj.com/rank/2-0-0-0.json')
+log = logging.getLogger(__name__)
+
+RANK = 'https://m.dmzj.com'
+DMZJ = 'http://api.dmzj.com'
+CATEGORIES = ['2-0-0']  # Rank type, tag and period, as in /rank/2-0-0-<page>.json; 2 is subscriptions
+TYPES = {'0': '人气', '1': '吐槽', '2': '订阅'}
+PERIODS = {'0': '', '1': '周', '2': '月', '3': '总'}  # 0 is daily, the caption never said so
+
+
+def Ranks(categories: list[str], pages: int = 1, workers=8, limit=RateLimit()) -> list[dict]:
+    """各分类前 pages 页的条目, 带上分类和在分类里的名次; 一页失败了, 这个分类后面的页也不要了, 名次对不上"""
+    def Page(path: str) -> list[dict] | None:
+        limit(RANK)
+        try:
+            with Span('dmzj_rank'):
+                r = HTTP.get(f'{RANK}/rank/{path}.json')
+            r.raise_for_status()
+            return r.json()
+        except (RequestException, ValueError) as e:
+            log.warning('rank %s skipped: %s', path, e)
+            METRICS.count('dropped_total', reason='rank_page')
+            return None
+
+    paths = [f'{category}-{page}' for category in categories for page in range(pages)]
     out = []
-    if r.status_code == 200:
-        out = r.json()
-    for l in range(len(out)):
-        r = get(f'http://api.dmzj.com/dynamic/comicinfo/{out[l]["id"]}.json').json()['data']['info']
-        out[l]['name'] = ' '.join(jieba.cut(r['title']))
-        out[l]['name_ja'] = r['subtitle']
-        out[l]['description'] = ' '.join(jieba.cut(r['description']))
-        out[l]['last_update_chapter_name'] = r['last_update_chapter_name']
-        out[l]['types'] = r['types'].split('/')
-        out[l]['authors'] = r['authors'].split('/')
-        out[l]['cover'] = r['cover']
-        out[l]['color'] = Color(PIL.Image.open(BytesIO(get(out[l]['cover']).content))) or (34, 37, 38)
-        out[l]['ranking'] = l + 1
+    for i, items in enumerate(Map(Page, paths, workers)):
+        if i % pages == 0: ranking, broken = 0, False
+        broken = broken or items is None
+        if broken: continue
+        for c in items:
+            ranking += 1
+            out.append({**c, 'category': categories[i // pages], 'ranking': ranking})
     return out
 
-def Color(image):
-    """要提取的主要颜色"""
-    try:
-        num_colors = 20 
-        small_image = image.resize((80, 80))
-        result = small_image.convert('P', palette=PIL.Image.Palette.ADAPTIVE, colors=num_colors)
-        result = result.convert('RGB')
-        main_colors = result.getcolors()
-        main_color = sorted(main_colors, key=lambda x: x[0], reverse=True)[0][1]
-        if main_color[0] < 120:
-            main_color = (150, main_color[1], main_color[2])
-        if main_color[1] > 160:
-            main_color = (main_color[0], 150, main_color[2])
-    except:
-        return None
-    return main_color
 
-def Wrap(text: str, width: float, font: FreeTypeFont, line=-1) -> list[str]:
-    space = font.getlength(' ')
-    dots = font.getlength('...')
-    words = text.split()
-    lens = tuple(accumulate(map(space.__add__, map(font.getlength, words))))  # Widths of words, each plus a space
-    out = []
-    w = width + space
-    while line and words:
-        i = bisect_left(lens, w)
-        if line == 1:
-            for j in reversed(range(i)):
-                dots -= lens[j]
-                if dots > 0:
-                    words[j] = ''
-                else:
-                    words[j] = '...'
-                    break
-        out.append(''.join(words[:i]))
-        w = width + lens[i - 1] + space  # Ignore space at line end
-        words = words[i:]
-        lens = lens[i:]
-        line -= 1
+def Title(category: str) -> str:
+    """推送的标题, 如 2-0-0 是 动漫之家漫画订阅排行"""
+    type, tag, period = category.split('-')
+    title = f"动漫之家漫画{TYPES.get(type, type)}{PERIODS.get(period, period)}排行"
+    return title if tag == '0' else f"{title} (分类 {tag})"
+
+
+def Fetch(categories: list[str] = CATEGORIES, pages: int = 1, workers=8, rate=10.0) -> list[dict]:
+    """获取排行榜数据, 同时补充各条目的详情和封面; 出错的条目跳过, 其余的名次不变"""
+    limit = RateLimit(rate)
+    out = Ranks(categories, pages, workers, limit)
+
+    def Item(c: dict) -> tuple[dict, tuple] | None:
+        try:
+            with Span('dmzj_item'):
+                url = f'{DMZJ}/dynamic/comicinfo/{c["id"]}.json'
+                limit(url)
+                with Span('dmzj_info'):
+                    r = HTTP.get(url)
+                r.raise_for_status()
+                r = r.json()['data']['info']
+                color, _ = Dominant(images.COVERS.get(r['cover']), clamp=True)
+                return r, color
+        except (RequestException, KeyError, TypeError, ValueError) as e:
+            log.warning('comic %s at %s skipped: %s', c['id'], c['ranking'], e)
+            METRICS.count('dropped_total', reason='comic')
+            return None
+
+    first = {}  # Comic id -> its first entry; details are shared by the categories it is ranked in
+    for c in out:
+        first.setdefault(c['id'], c)
+    info = dict(zip(first, Map(Item, first.values(), workers)))
+    out = [c for c in out if info[c['id']]]
+    words = iter(CutAll([text for c in out for text in (info[c['id']][0]['title'], info[c['id']][0]['description'])]))
+    for c in out:
+        r, color = info[c['id']]
+        c['name'] = next(words)
+        c['name_ja'] = r['subtitle']
+        c['description'] = next(words)
+        c['last_update_chapter_name'] = r['last_update_chapter_name']
+        c['types'] = r['types'].split('/')
+        c['authors'] = r['authors'].split('/')
+        c['cover'] = r['cover']
+        c['color'] = color
     return out
 
-def Card(info: list[dict]) -> list[bytes]:
-    re0 = compile(r'Season (\d+)')  # E.g., Season 2 -> 2
-    re1 = compile(r'<.*?>')  # E.g., <br>, <i>
-    re2 = compile(r'\(Source: .*?\)')  # Usually at end
-    re3 = compile(r'Note: .*')  # Usually at end
-
-    fontM = truetype('font/NotoSansSC-Medium.otf', 72)
-    # fontJ = truetype('font/sarasa-ui-j-regular.ttf', 48)
-    # font1 = truetype('font/OpenSans-VariableFont_wdth,wght.ttf', 24)
-    font1 = truetype('font/NotoSansSC-Medium.otf', 24)
-    font2 = font1.font_variant(size=36)
-    font3 = font1.font_variant(size=48)
-    # font1.set_variation_by_name('Condensed Bold')
-    # font2.set_variation_by_name('Condensed Bold')
-    # font3.set_variation_by_name('Condensed Bold')
+def Wrap(text: str, width: float, font: FreeTypeFont, line=-1) -> list[str]:
+    return layout.Wrap(text, width, font, line, no_space=True, dots='...')
 
-    out = []
-    for data in info:
-        image = PIL.Image.new('RGB', (1000, 650), '#222526')
-        draw = Draw(image)
-        xl = 490
-        width = 500
-        color = data['color']
-
-        # Thumbnail
-        # ----------------------------------------
-        with PIL.Image.open(BytesIO(get(data['cover']).content)) as thumb:
-            size = (460, 650)  # Thumbnail size
-            r = min(map(truediv, thumb.size, size))
-            w = r * size[0]
-            h = r * size[1]
-            l = max(0, (thumb.size[0] - w) / 2)
-            t = max(0, (thumb.size[1] - h) / 2)
-            r = min(thumb.size[0], (thumb.size[0] + w) / 2)
-            b = min(thumb.size[1], (thumb.size[1] + h) / 2)
-            image.paste(thumb.resize(size, 1, (l, t, r, b), 2))  # Lanczos
-
-            size = (540, 650)  # TODO: Don't hardcode
-            r = 0.5 * min(map(truediv, thumb.size, size))
-            w = r * size[0]
-            h = r * size[1]
-            l = max(0, (thumb.size[0] - w) / 2)
-            t = max(0, (thumb.size[1] - h) / 2)
-            r = min(thumb.size[0], (thumb.size[0] + w) / 2)
-            b = min(thumb.size[1], (thumb.size[1] + h) / 2)
-            image.paste(Brightness(thumb.resize(size, 1, (l, t, r, b), 2)).enhance(0.25).filter(GaussianBlur(9)), (460, 0))
-
-        # Last Update Name
-        # ----------------------------------------
-        yt = 30
-        margin = 14
-        last_update = f"最后一次更新 {data['last_update_chapter_name']}"
-
-        _, t, _, b = font1.getbbox('A')
-        yt += b - t
-        draw.text((xl, yt), last_update, 'darkgray', font1, 'ls')
-        yt += margin
-
-        # Ranking
-        # ----------------------------------------
-        l, t, r, b = fontM.getbbox('0')
-        yt += b - t
+re0 = compile(r'Season (\d+)')  # E.g., Season 2 -> 2
+re1 = compile(r'<.*?>')  # E.g., <br>, <i>
+re2 = compile(r'\(Source: .*?\)')  # Usually at end
+re3 = compile(r'Note: .*')  # Usually at end
+
+
+CARD = Template((1000, 650), '#222526', {
+    'M': ('font/NotoSansSC-Medium.otf', 72),
+    '1': ('font/NotoSansSC-Medium.otf', 24),
+    '2': ('font/NotoSansSC-Medium.otf', 36),
+    '3': ('font/NotoSansSC-Medium.otf', 48),
+}, {
+    'thumb': (0, 0, *images.THUMB),
+    'panel': (images.THUMB[0], 0, 1000, 650),
+    'text': (490, 30, 990, 550),  # Header grows down from the top, title and authors grow up from the bottom
+    'tags': (490, 610, 990, 610),
+}, cache='cache/cards/comics')
+
+
+def Head(data: dict, draw: ImageDraw = None) -> float:
+    """头部: 最后更新, 排名和时间, 每次都变; 返回头部下方的 yt, draw 为 None 时只算位置"""
+    fonts = CARD.fonts
+    fontM, font1 = fonts['M'], fonts['1']
+    xl, yt, _, _ = CARD.regions['text']
+    color = data['color']
+
+    # Last Update Name
+    # ----------------------------------------
+    margin = 14
+    yt = Line(draw, xl, yt, f"最后一次更新 {data['last_update_chapter_name']}", font1, 'darkgray', margin)
+
+    # Ranking
+    # ----------------------------------------
+    l, t, r, b = fontM.getbbox('0')
+    yt += b - t
+    if draw:
         h, s, v = rgb_to_hsv(*color)
         rgb = tuple(map(round, hsv_to_rgb(h, s * 0.4, v)))
-        draw.text((xl - 3, yt), '第 ', rgb, fontM, 'ls')
+        Text(draw, (xl - 3, yt), '第 ', rgb, fontM)
         if data['ranking'] < 10:
-            draw.text((xl - 3 + 2.3 * (r - l), yt), str(data['ranking']), color, fontM, 'ls')
-            draw.text((xl - 3 + 3.5 * (r - l), yt), ' 位', rgb, fontM, 'ls')
-        else:
-            draw.text((xl - 3 + 2 * (r - l), yt), str(data['ranking']), color, fontM, 'ls')
-            draw.text((xl - 3 + 4 * (r - l), yt), ' 位', rgb, fontM, 'ls')
-        yt += margin
-
-        # Format and source
-        # ----------------------------------------
-        _, t, _, b = font1.getbbox('A')
-        yt += b - t
-        draw.text((xl, yt), f"当前时间排名 {datetime.now().strftime('%Y/%m/%d %H:%M')}", 'white', font1, 'ls')
-        yt += margin * 1.5
-
-        # Author
-        # ----------------------------------------
-        yb = 550
-        margin = 16
-        authors = data['authors']
-        _, t, _, b = font2.getbbox('A')
-        spacing = 12
-        yb -= (len(authors) - 1) * (b - t + spacing)
-        draw.multiline_text((xl, yb), ' '.join(authors), color, font2, 'ls', spacing - t)
-        yb -= (b - t) + margin
-
-        # Title
-        # ----------------------------------------
-        title = re0.sub(r'\1', data['name'] or '')
-        _title_ja = data['name_ja']
-        title_ja = re0.sub(r'\1', (_title_ja if len(_title_ja) < 30 else _title_ja[:30] + " ...") or '')
-        if not title_ja:
-            title = Wrap(title, width, font3)
-            _, t, _, b = font3.getbbox('A')
-            spacing = 14
-            yb -= (len(title) - 1) * (b - t + spacing)
-            draw.multiline_text((xl, yb), '\n'.join(title), 'white', font3, 'ls', spacing - t)
-            yb -= (b - t) + margin * 1.5
+            Text(draw, (xl - 3 + 2.3 * (r - l), yt), str(data['ranking']), color, fontM)
+            Text(draw, (xl - 3 + 3.5 * (r - l), yt), ' 位', rgb, fontM)
         else:
-            title_ja = Wrap(title_ja, width, font1)
-            _, t, _, b = font1.getbbox('A')
-            spacing = 10
-            yb -= (len(title_ja) - 1) * (b - t + spacing)
-            draw.multiline_text((xl, yb), '\n'.join(title_ja), 'white', font1, 'ls', spacing - t)
-            yb -= (b - t) + margin
-            title = Wrap(title, width, font3)
-            _, t, _, b = font3.getbbox('A')
-            spacing = 14
-            yb -= (len(title) - 1) * (b - t + spacing)
-            draw.multiline_text((xl, yb), '\n'.join(title), 'white', font3, 'ls', spacing - t)
-            yb -= (b - t) + margin * 1.5
-
-        # Description
-        # ----------------------------------------
-        desc = re3.sub('', re2.sub('', re1.sub('', data['description'])))
-        _, t, _, b = font1.getbbox('A')
-        spacing = 10
-        yt += b - t
-        desc = Wrap(desc, width, font1, ceil((yb - yt + spacing) / (b - t + spacing)))
-        draw.multiline_text((xl, yt), '\n'.join(desc), 'gray', font1, 'ls', spacing - t)
-
-        # Genre
-        # ----------------------------------------
-        y = 610
-        border = 7
-        xr = xl + width
-        h, s, v = rgb_to_hsv(*color)
-        rgb = tuple(map(round, hsv_to_rgb(h, s, v * 0.6)))
-        for genre in data['types']:
-            l, t, r, b = draw.textbbox((xl, y), genre, font1, 'ls')
-            if r + 2 * border > xr: break  # Exceeding tags are dropped
-            draw.rectangle((l, y - border, r + 2 * border, y + border), rgb)
-            draw.text((l + border, y), genre, 'white', font1, 'ls')
-            xl += r - l + border * 4  # Move right
-
-        # Export
-        # ----------------------------------------
-        file = BytesIO()
-        image.save(file, 'PNG')  # .tobytes() is not for this
-        out.append(file.getvalue())
+            Text(draw, (xl - 3 + 2 * (r - l), yt), str(data['ranking']), color, fontM)
+            Text(draw, (xl - 3 + 4 * (r - l), yt), ' 位', rgb, fontM)
+    yt += margin
 
-    return out
+    # Format and source
+    # ----------------------------------------
+    return Line(draw, xl, yt, f"当前时间排名 {datetime.now().strftime('%Y/%m/%d %H:%M')}", font1, 'white', margin * 1.5)
+
+
+def Body(data: dict) -> PIL.Image.Image:
+    """头部以外的部分, 排行榜上的漫画大多每周都一样"""
+    fonts = CARD.fonts
+    font1 = fonts['1']
+    xl, _, xr, yb = CARD.regions['text']
+    width = xr - xl
+    color = data['color']
+    image, draw = CARD.new(data['cover'])
+    yt = Head(data)
+
+    # Author
+    # ----------------------------------------
+    margin = 16
+    yb = Stack(draw, xl, yb, data['authors'], fonts['2'], color, 12, margin, join=' ')
+
+    # Title
+    # ----------------------------------------
+    title = re0.sub(r'\1', data['name'] or '')
+    _title_ja = data['name_ja']
+    title_ja = re0.sub(r'\1', (_title_ja if len(_title_ja) < 30 else _title_ja[:30] + " ...") or '')
+    if not title_ja:
+        yb = Stack(draw, xl, yb, Wrap(title, width, fonts['3']), fonts['3'], 'white', 14, margin * 1.5)
+    else:
+        yb = Stack(draw, xl, yb, Wrap(title_ja, width, font1), font1, 'white', 10, margin)
+        yb = Stack(draw, xl, yb, Wrap(title, width, fonts['3']), fonts['3'], 'white', 14, margin * 1.5)
+
+    # Description
+    # ----------------------------------------
+    desc = re3.sub('', re2.sub('', re1.sub('', data['description'])))
+    Fill(draw, xl, yt, yb, desc, width, font1, 'gray', 10, no_space=True, dots='...')
 
-def Task() -> None:
+    # Genre
+    # ----------------------------------------
+    h, s, v = rgb_to_hsv(*color)
+    rgb = tuple(map(round, hsv_to_rgb(h, s, v * 0.6)))
+    xl, y, xr, _ = CARD.regions['tags']
+    Tags(draw, xl, y, xr, data['types'], font1, rgb)
+
+    return image
+
+
+def Render(data: dict) -> bytes:
+    head = {k: data[k] for k in ('last_update_chapter_name', 'ranking', 'color')}
+    head.update(now=datetime.now().strftime('%Y/%m/%d %H:%M'))
+    body = {k: data[k] for k in ('name', 'name_ja', 'description', 'types', 'authors', 'color')}
+    body.update(cover=images.COVERS.digest(data['cover']))
+    return CARD.render(head, body, lambda: Body(data), lambda draw: Head(data, draw))
+
+
+def Card(info: list[dict], workers=1) -> list[bytes]:
+    return list(Imap(Render, info, workers, CARD.load))
+
+def Task(workers=1, categories: list[str] = CATEGORIES, pages: int = 1, fetch_workers=8, fetch_rate=10.0) -> None:
     send_id = 0
     start = datetime.now()
     start = start.replace(hour=17, minute=0, second=0, microsecond=0)
-    cards = Card(Fetch())
-    total = ceil(len(cards) / 10)
+    info = Fetch(categories, pages, fetch_workers, fetch_rate)
+    cards = Imap(Render, info, workers, CARD.load)
+    totals = Counter(c['category'] for c in info)
     isoformat = start.date().isoformat()
     bot = telebot.TeleBot('token') # set your token here
-    for i, chunk in enumerate(chunked(cards, 10)):
-        media = list(map(telebot.types.InputMediaPhoto, chunk))
-        media[0].caption = f"`动漫之家漫画订阅排行\n{i + 1}/{total} {isoformat} (UTC+9)`"
-        media[0].parse_mode = 'markdown'
-        bot.send_media_group(send_id, media)
+    sender = Sender(bot, send_id)
+
+    def Albums():
+        """每个分类一组相册, 各自从第 1 位编号; 渲染不在分类之间停下"""
+        for category, group in groupby(zip(info, cards), key=lambda pair: pair[0]['category']):
+            for i, chunk in enumerate(chunked((card for _, card in group), 10)):
+                yield category, i, chunk
+
+    chunks = Prefetch(Albums(), 1)
+    try:
+        for category, i, chunk in chunks:
+            media = list(map(telebot.types.InputMediaPhoto, chunk))
+            media[0].caption = f"`{Title(category)}\n{i + 1}/{ceil(totals[category] / 10)} {isoformat} (UTC+9)`"
+            media[0].parse_mode = 'markdown'
+            sender.send_media_group(media)
+    finally:
+        chunks.close()  # Stops the prefetching thread
+        cards.close()  # And the render workers, if sending failed
+    log.info('push: %s', sender)
+    if CARD.encoder.stats: log.info('encode: %s', CARD.encoder)  # Empty when cards were rendered in other processes
+    images.COVERS.prune()
+    CARD.cache.prune()
 
 if __name__ == '__main__':
-    Task()
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument('-j', '--workers', type=int, default=1, help='render cards in this many processes')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='concurrent requests to dmzj')
+    parser.add_argument('--fetch-rate', type=float, default=10.0, help='requests a second to each dmzj host')
+    parser.add_argument('--fast-covers', action='store_true', help='draft-mode decode and reduced-resolution blur for covers')
+    Encoder.add_arguments(parser)
+    parser.add_argument('--rank', nargs='+', default=CATEGORIES, metavar='TYPE-TAG-PERIOD', help='rankings to push, as in the dmzj rank path')
+    parser.add_argument('--pages', type=int, default=1, help='pages of each ranking')
+    parser.add_argument('--metrics', help='write Prometheus metrics to this file after the run')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this local port during the run')
+    args = parser.parse_args()
+    images.COVERS.fast = args.fast_covers
+    CARD.encoder = Encoder.from_args(args)
+    if args.metrics_port: METRICS.serve(args.metrics_port)
+    with METRICS.run('comics', args.metrics):
+        Task(args.workers, args.rank, args.pages, args.fetch_workers, args.fetch_rate)
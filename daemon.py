@@ -0,0 +1,99 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from typing import Callable
+import logging
+import sys
+import time
+
+import anime
+import comics
+import images
+import layout
+from metrics import METRICS, Span
+import segment
+from template import Encoder
+
+log = logging.getLogger(__name__)
+
+
+def Next(times: list[str], now: datetime) -> datetime:
+    """times 是每天的 HH:MM, 返回 now 之后最早的一个"""
+    out = []
+    for t in times:
+        hour, minute = map(int, t.split(':'))
+        at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        out.append(at if at > now else at + timedelta(1))
+    return min(out)
+
+
+def Warm() -> None:
+    """导入之外的冷启动: jieba 词典, 两种卡片的字体和底图, 折行用到的字体里每个汉字和假名的宽度; 渲染进程是 fork 出来的, 也都是热的"""
+    with Span('warm'):
+        segment.Tokenizer()
+        for card in anime.CARD, comics.CARD:
+            card.load()
+            for name in '1', '3':  # The fonts Wrap measures; both cards share them
+                layout.Preload(card.fonts[name], layout.KANA + layout.CJK)
+
+
+def Run(name: str, fn: Callable[[], None], metrics: str = None) -> bool:
+    """跑一次任务, 失败了记下来, 不影响之后的"""
+    images.COVERS.clear()  # Covers are revalidated once per run
+    try:
+        with METRICS.run(name, metrics):
+            fn()
+    except Exception:
+        log.exception('%s failed', name)
+        return False
+    return True
+
+
+def Daemon(tasks: dict[str, tuple[Callable[[], None], list[str]]], metrics: str = None) -> None:
+    """按时间表一直跑下去; 一次运行超过了下一个时间点的, 那一次就跳过"""
+    due = {name: Next(times, datetime.now()) for name, (_, times) in tasks.items()}
+    while True:
+        name = min(due, key=due.get)
+        log.info('next: %s at %s', name, due[name])
+        while (wait := (due[name] - datetime.now()).total_seconds()) > 0:
+            time.sleep(min(wait, 60))  # Wakes up now and then, in case the clock was changed
+        fn, times = tasks[name]
+        Run(name, fn, metrics)
+        due[name] = Next(times, max(datetime.now(), due[name]))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    parser = ArgumentParser(description='keeps fonts, jieba and connections warm between pushes')
+    parser.add_argument('--anime', nargs='+', metavar='HH:MM', default=[], help='push anime at these local times every day')
+    parser.add_argument('--comics', nargs='+', metavar='HH:MM', default=[], help='push comics at these local times every day')
+    parser.add_argument('--once', action='store_true', help='run each scheduled task once now, then exit')
+    parser.add_argument('--jobs', help='JSON list of channels for anime, read before every run, see anime.Job.parse')
+    parser.add_argument('--rank', nargs='+', default=comics.CATEGORIES, metavar='TYPE-TAG-PERIOD', help='comic rankings to push, as in the dmzj rank path')
+    parser.add_argument('--pages', type=int, default=1, help='pages of each comic ranking')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='render cards in this many processes')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='concurrent requests to each upstream')
+    parser.add_argument('--anime-rate', type=float, default=5.0, help='requests a second to each of AniList and bgm.tv')
+    parser.add_argument('--comics-rate', type=float, default=10.0, help='requests a second to each dmzj host')
+    parser.add_argument('--fast-covers', action='store_true', help='draft-mode decode and reduced-resolution blur for covers')
+    Encoder.add_arguments(parser)
+    parser.add_argument('--metrics', help='write Prometheus metrics to this file after every run')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this local port')
+    args = parser.parse_args()
+    if not args.anime and not args.comics: parser.error('nothing scheduled, give --anime or --comics times')
+    for t in args.anime + args.comics:
+        try:
+            Next([t], datetime.now())
+        except ValueError:
+            parser.error(f'{t} is not HH:MM')
+    images.COVERS.fast = args.fast_covers
+    anime.CARD.encoder = Encoder.from_args(args)
+    comics.CARD.encoder = Encoder.from_args(args)
+    METRICS.labels['task'] = 'daemon'  # Counters are for the whole process, run_* are per task
+    if args.metrics_port: METRICS.serve(args.metrics_port)
+    tasks = {}
+    if args.anime: tasks['anime'] = (lambda: anime.Task(args.workers, args.jobs and anime.Jobs(args.jobs), args.fetch_workers, args.anime_rate)), args.anime
+    if args.comics: tasks['comics'] = (lambda: comics.Task(args.workers, args.rank, args.pages, args.fetch_workers, args.comics_rate)), args.comics
+    Warm()
+    if args.once:
+        sys.exit(not all([Run(name, fn, args.metrics) for name, (fn, _) in tasks.items()]))
+    Daemon(tasks, args.metrics)
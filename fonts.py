@@ -0,0 +1,196 @@
+from bisect import bisect_right
+from functools import cache, lru_cache
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+from struct import iter_unpack, unpack_from
+import logging
+import os
+
+from PIL.ImageDraw import ImageDraw
+from PIL.ImageFont import FreeTypeFont
+
+from layout import ASCII, Preload
+
+log = logging.getLogger(__name__)
+
+FALLBACK = [  # Tried after the face asked for, in this order; missing files are skipped
+    ('font/NotoSansSC-Medium.otf', 0),
+    ('/usr/share/fonts/opentype/noto/NotoSansCJK-Medium.ttc', 2),  # 2 is SC in the collection
+    ('/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc', 2),
+    ('/usr/share/fonts/truetype/wqy/wqy-microhei.ttc', 0),
+    ('font/iosevka-bold.ttf', 0),
+    ('font/NotoSansSymbols2-Regular.ttf', 0),
+]
+
+
+def Cmap(path: str, index: int = 0) -> list[tuple[int, int]]:
+    """字体里有字形的码位, 合并成有序的 (first, last) 区间; 只映射进来读 cmap 表, 不读整个文件"""
+    with open(path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+        offset = unpack_from('>L', data, 12 + 4 * index)[0] if data[:4] == b'ttcf' else 0
+        for i in range(unpack_from('>H', data, offset + 4)[0]):
+            tag, _, start, _ = unpack_from('>4sLLL', data, offset + 12 + 16 * i)
+            if tag == b'cmap': break
+        else:
+            return []
+        subtables = {}
+        for i in range(unpack_from('>H', data, start + 2)[0]):
+            platform, encoding, at = unpack_from('>HHL', data, start + 4 + 8 * i)
+            subtables[platform, encoding] = start + at
+        for key in (3, 10), (0, 6), (0, 4), (3, 1), (0, 3):  # Full Unicode first
+            if key not in subtables: continue
+            at = subtables[key]
+            format = unpack_from('>H', data, at)[0]
+            if format == 12:
+                groups = unpack_from('>L', data, at + 12)[0]
+                ranges = [(first + (glyph == 0), last) for first, last, glyph in iter_unpack('>LLL', data[at + 16:at + 16 + 12 * groups])]
+                break
+            if format == 4:
+                ranges = Format4(data, at)
+                break
+        else:
+            return []
+    out = []
+    for first, last in sorted(r for r in ranges if r[0] <= r[1]):
+        if out and first <= out[-1][1] + 1:
+            out[-1] = out[-1][0], max(out[-1][1], last)
+        else:
+            out.append((first, last))
+    return out
+
+
+def Format4(data, at: int) -> list[tuple[int, int]]:
+    """BMP 的分段映射; 有 idRangeOffset 的段逐个码位查字形"""
+    n = unpack_from('>H', data, at + 6)[0] // 2
+    lasts = unpack_from(f'>{n}H', data, at + 14)
+    firsts = unpack_from(f'>{n}H', data, at + 16 + 2 * n)
+    deltas = unpack_from(f'>{n}H', data, at + 16 + 4 * n)
+    offsets = at + 16 + 6 * n
+    out = []
+    for i, (first, last, delta, offset) in enumerate(zip(firsts, lasts, deltas, unpack_from(f'>{n}H', data, offsets))):
+        if first == 0xFFFF: continue
+        if offset == 0:  # Glyph is code + delta, so only one code can map to glyph 0
+            zero = -delta & 0xFFFF
+            out += [(first, min(last, zero - 1)), (max(first, zero + 1), last)] if first <= zero <= last else [(first, last)]
+        else:
+            glyphs = unpack_from(f'>{last - first + 1}H', data, offsets + 2 * i + offset)
+            out += [(code, code) for code, glyph in zip(range(first, last + 1), glyphs) if glyph and (glyph + delta) & 0xFFFF]
+    return out
+
+
+class Coverage:
+    """一个字体覆盖的码位, 按区间二分查找"""
+
+    def __init__(self, ranges: list[tuple[int, int]]):
+        self.firsts = [first for first, _ in ranges]
+        self.lasts = [last for _, last in ranges]
+
+    def __contains__(self, char: str) -> bool:
+        code = ord(char)
+        i = bisect_right(self.firsts, code) - 1
+        return i >= 0 and code <= self.lasts[i]
+
+
+@cache
+def Covers(path: str, index: int = 0) -> Coverage:
+    return Coverage(Cmap(path, index))
+
+
+@cache
+def Plain(path: str, size: int, index: int = 0) -> FreeTypeFont:
+    """后备字体本身, 每个文件每个字号只加载一次"""
+    return FreeTypeFont(path, size, index)
+
+
+class Face(FreeTypeFont):
+    """带后备字体的字体: 自己没有的字形, 用 fallbacks 里第一个有的画, 都没有时还用自己
+
+    getlength 按分段量, 画的时候要用 Text, Multiline 或 Box, 直接 draw.text 只会用自己
+    """
+
+    def __init__(self, path: str, size: int, index: int = 0, fallbacks: list[FreeTypeFont] = ()):
+        super().__init__(path, size, index)
+        self.chain = [self, *fallbacks]
+        self.files = tuple((font.path, font.index) for font in self.chain)
+        self.covers = [Covers(font.path, font.index) for font in self.chain]
+        self.ascii = all(c in self.covers[0] for c in ASCII)  # Then ASCII text is one run without looking at it
+        self.picks = {}  # Char -> font that draws it
+
+    def pick(self, char: str) -> FreeTypeFont:
+        try:
+            return self.picks[char]
+        except KeyError:
+            font = self.picks[char] = next((font for font, covers in zip(self.chain, self.covers) if char in covers), self)
+            return font
+
+    def getlength(self, text: str, *args, **kwargs) -> float:
+        if len(text) == 1:  # Preloading a whole block must not flush Runs
+            return FreeTypeFont.getlength(self.pick(text), text, *args, **kwargs)
+        return sum(FreeTypeFont.getlength(font, run, *args, **kwargs) for run, font in Runs(self, text))
+
+
+@lru_cache(16384)
+def Runs(font: FreeTypeFont, text: str) -> tuple[tuple[str, FreeTypeFont], ...]:
+    """text 按画它的字体分段; 空白跟着前一段, 不另起一段"""
+    if not isinstance(font, Face) or font.ascii and text.isascii():
+        return (text, font),
+    out = []
+    for char in text:
+        face = out[-1][1] if out and char.isspace() else font.pick(char)
+        if out and out[-1][1] is face:
+            out[-1][0].append(char)
+        else:
+            out.append(([char], face))
+    return tuple((''.join(chars), face) for chars, face in out) or ((text, font),)
+
+
+@cache
+def Font(path: str, size: int) -> Face:
+    """path 加上 FALLBACK 里的其他字体; path 不存在时用 FALLBACK 里第一个有的"""
+    files, seen = [], set()
+    for file, index in [(path, 0), *FALLBACK]:
+        if not Path(file).exists():
+            if file == path: log.warning('%s not found, falling back', path)
+            continue
+        if (os.path.realpath(file), index) not in seen:  # E.g. a symlink to another face
+            seen.add((os.path.realpath(file), index))
+            files.append((file, index))
+    if not files: raise OSError(f'none of {path} and the fallback fonts exist')
+    (file, index), *fallbacks = files
+    font = Face(file, size, index, [Plain(file, size, index) for file, index in fallbacks])
+    Preload(font)
+    return font
+
+
+def Text(draw: ImageDraw, xy: tuple[float, float], text: str, fill, font: FreeTypeFont, anchor: str = 'ls') -> None:
+    """draw.text, 自己没有的字形用后备字体画; 分段时 anchor 只能靠左"""
+    runs = Runs(font, text)
+    if len(runs) == 1:
+        return draw.text(xy, text, fill, runs[0][1], anchor)
+    x, y = xy
+    for run, face in runs:
+        draw.text((x, y), run, fill, face, anchor)
+        x += FreeTypeFont.getlength(face, run)
+
+
+def Multiline(draw: ImageDraw, xy: tuple[float, float], text: str, fill, font: FreeTypeFont, anchor: str, spacing: float) -> None:
+    """draw.multiline_text, 行距同 PIL; 有要分段的行时逐行用 Text"""
+    if len(Runs(font, text)) == 1:
+        return draw.multiline_text(xy, text, fill, font, anchor, spacing)
+    x, y = xy
+    height = font.getbbox('A')[3] + spacing
+    for line in text.split('\n'):
+        Text(draw, (x, y), line, fill, font, anchor)
+        y += height
+
+
+@lru_cache(4096)
+def Box(font: FreeTypeFont, text: str, anchor: str = 'ls') -> tuple[float, float, float, float]:
+    """在原点画 text 的边界, 同 draw.textbbox((0, 0), ...); 分段时是各段的并集"""
+    x = 0
+    boxes = []
+    for run, face in Runs(font, text):
+        l, t, r, b = FreeTypeFont.getbbox(face, run, anchor=anchor)
+        boxes.append((l + x, t, r + x, b))
+        x += FreeTypeFont.getlength(face, run)
+    l, t, r, b = zip(*boxes)
+    return min(l), min(t), max(r), max(b)
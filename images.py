@@ -0,0 +1,143 @@
+from hashlib import sha256
+from io import BytesIO
+from math import ceil
+from operator import truediv
+from threading import Lock
+import os
+
+import PIL.Image
+from PIL.ImageEnhance import Brightness
+from PIL.ImageFilter import GaussianBlur
+
+from cache import Cache, Files
+from metrics import METRICS, Span
+from net import HTTP
+
+THUMB = (460, 650)  # Thumbnail size
+PANEL = (540, 650)  # Blurred background behind the text
+
+
+def Crop(image: PIL.Image.Image, size: tuple, zoom=1.0) -> PIL.Image.Image:
+    """居中裁剪并缩放到 size"""
+    r = zoom * min(map(truediv, image.size, size))
+    w = r * size[0]
+    h = r * size[1]
+    l = max(0, (image.size[0] - w) / 2)
+    t = max(0, (image.size[1] - h) / 2)
+    r = min(image.size[0], (image.size[0] + w) / 2)
+    b = min(image.size[1], (image.size[1] + h) / 2)
+    return image.resize(size, 1, (l, t, r, b), 2)  # Lanczos
+
+
+def Decode(data: bytes) -> PIL.Image.Image:
+    image = PIL.Image.open(BytesIO(data))
+    image.load()
+    return image
+
+
+def Thumb(image: PIL.Image.Image, size=THUMB) -> PIL.Image.Image:
+    return Crop(image, size)
+
+
+def Blur(image: PIL.Image.Image, size=PANEL) -> PIL.Image.Image:
+    """放大一倍, 调暗, 模糊"""
+    return Brightness(Crop(image, size, 0.5)).enhance(0.25).filter(GaussianBlur(9))
+
+
+def Panels(raw: bytes, thumb=THUMB, panel=PANEL) -> tuple[PIL.Image.Image, PIL.Image.Image]:
+    with PIL.Image.open(BytesIO(raw)) as image:
+        return Thumb(image, thumb), Blur(image, panel)
+
+
+def FastPanels(raw: bytes, thumb=THUMB, panel=PANEL, reduce=4) -> tuple[PIL.Image.Image, PIL.Image.Image]:
+    """同 Panels, 但 JPEG 直接以够用的分辨率解码, 背景缩小 reduce 倍模糊后再放大"""
+    with PIL.Image.open(BytesIO(raw)) as image:
+        small = ceil(panel[0] / reduce), ceil(panel[1] / reduce)
+        # Smallest decode that still has a source pixel for every output pixel of both crops
+        r = min(min(map(truediv, image.size, thumb)), 0.5 * min(map(truediv, image.size, small)))
+        if r > 1: image.draft('RGB', (ceil(image.size[0] / r), ceil(image.size[1] / r)))
+        thumb = Crop(image, thumb)
+        small = Crop(image, small, 0.5)
+        panel = Brightness(small).enhance(0.25).filter(GaussianBlur(9 / reduce)).resize(panel, PIL.Image.Resampling.BICUBIC)
+    return thumb, panel
+
+
+class Images:
+    """封面缓存: 按内容寻址存储原图和裁剪后的缩略图, 用 ETag/Last-Modified 重新验证"""
+
+    def __init__(self, root: str, size: int = 1024, age: float = 30 * 86400, fast=False):
+        self.files = Files(root, age)
+        self.fast = fast  # FastPanels instead of Panels
+        self.index = Cache(f'{root}/index.db', size)  # url -> digest and validators
+        self.lock = Lock()
+        self.locks = {}
+        self.raw = {}  # url -> digest, for this run
+
+    def once(self, key) -> Lock:
+        with self.lock:
+            return self.locks.setdefault(key, Lock())
+
+    def digest(self, url: str) -> str:
+        with self.once(url):
+            if url in self.raw: return self.raw[url]
+            entry = self.index.get(url)
+            headers = {}
+            if entry and entry.get('digest') and self.files.path(entry['digest']).exists():
+                if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+                if entry.get('modified'): headers['If-Modified-Since'] = entry['modified']
+            with Span('cover_download'):
+                r = HTTP.get(url, headers=headers)
+            METRICS.count('cover_requests_total', result=r.status_code == 304 and 'not_modified' or 'downloaded')
+            if r.status_code == 304:
+                digest = entry['digest']
+                os.utime(self.files.path(digest))
+            else:
+                r.raise_for_status()
+                digest = sha256(r.content).hexdigest()
+                if not self.files.path(digest).exists():
+                    self.files.write(self.files.path(digest), r.content)
+                self.index.set(url, {'digest': digest, 'etag': r.headers.get('ETag'), 'modified': r.headers.get('Last-Modified')})
+            self.raw[url] = digest
+            return digest
+
+    def get(self, url: str) -> bytes:
+        """原图"""
+        digest = self.digest(url)
+        data = self.files.read(self.files.path(digest))
+        if data is None:  # Pruned underneath us
+            with self.lock:
+                self.raw.pop(url, None)
+            self.index.set(url, {})
+            return self.get(url)
+        return data
+
+    def get_panels(self, url: str, thumb=THUMB, panel=PANEL) -> tuple[PIL.Image.Image, PIL.Image.Image]:
+        """裁剪好的缩略图和模糊背景"""
+        digest = self.digest(url)
+        mode = '.fast' if self.fast else ''
+        suffixes = f'.{thumb[0]}x{thumb[1]}{mode}.thumb.png', f'.{panel[0]}x{panel[1]}{mode}.panel.png'
+        with self.once((digest, thumb, panel, self.fast)):  # Not kept in memory, the PNGs are the cache
+            files = [self.files.read(self.files.path(digest, suffix)) for suffix in suffixes]
+            if all(files):
+                out = tuple(map(Decode, files))
+            else:
+                raw = self.get(url)
+                with Span('panels'):
+                    out = (FastPanels if self.fast else Panels)(raw, thumb, panel)
+                for image, suffix in zip(out, suffixes):
+                    file = BytesIO()
+                    image.save(file, 'PNG')
+                    self.files.write(self.files.path(digest, suffix), file.getvalue())
+            return out
+
+    def clear(self) -> None:
+        """开始新一轮运行"""
+        with self.lock:
+            self.raw.clear()
+            self.locks.clear()
+
+    def prune(self) -> None:
+        self.files.prune()
+
+
+COVERS = Images('cache/images')
@@ -0,0 +1,64 @@
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+
+from PIL.ImageFont import FreeTypeFont
+
+ASCII = ''.join(map(chr, range(0x20, 0x7F)))
+PUNCT = ''.join(map(chr, range(0x3000, 0x3040))) + ''.join(map(chr, range(0xFF00, 0xFF60)))  # CJK symbols, full width forms
+KANA = ''.join(map(chr, range(0x3040, 0x3100)))
+CJK = ''.join(map(chr, range(0x4E00, 0xA000)))
+
+widths = {}  # (path, size, index, fallbacks) -> {text: advance width}
+
+
+def Widths(font: FreeTypeFont) -> dict:
+    return widths.setdefault((font.path, font.size, font.index, getattr(font, 'files', None)), {})
+
+
+def Length(font: FreeTypeFont, text: str) -> float:
+    """带缓存的 font.getlength"""
+    table = Widths(font)
+    try:
+        return table[text]
+    except KeyError:
+        w = table[text] = font.getlength(text)
+        return w
+
+
+def Preload(font: FreeTypeFont, chars: str = ASCII + PUNCT) -> None:
+    """预先测量单个字符, jieba 切出的单字词直接命中; 默认只有 ASCII 和标点, 常驻进程可以再加上 KANA + CJK"""
+    table = Widths(font)
+    for c in chars:
+        if c not in table: table[c] = font.getlength(c)
+
+
+@lru_cache(4096)
+def _Wrap(text: str, width: float, font: FreeTypeFont, line: int, no_space: bool, dots: str) -> tuple[str, ...]:
+    space = Length(font, ' ')
+    rest = Length(font, dots)
+    words = text.split()
+    lens = tuple(accumulate(map(space.__add__, (Length(font, word) for word in words))))  # Widths of words, each plus a space
+    out = []
+    w = width + space
+    while line and words:
+        i = bisect_left(lens, w)
+        if line == 1:
+            for j in reversed(range(i)):
+                rest -= lens[j]
+                if rest > 0:
+                    words[j] = ''
+                else:
+                    words[j] = dots
+                    break
+        out.append(('' if no_space else ' ').join(words[:i]))
+        w = width + lens[i - 1] + space  # Ignore space at line end
+        words = words[i:]
+        lens = lens[i:]
+        line -= 1
+    return tuple(out)
+
+
+def Wrap(text: str, width: float, font: FreeTypeFont, line=-1, no_space=False, dots='[...]') -> list[str]:
+    """按宽度折行, 最多 line 行, 截断处以 dots 结尾; no_space 时词之间不加空格 (已分词的中文)"""
+    return list(_Wrap(text, width, font, line, no_space, dots))
@@ -0,0 +1,176 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'actimepush_'
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))  # Histogram upper bounds, in seconds
+
+
+def Labels(labels: dict) -> str:
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+
+
+def Number(value: float) -> str:
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+class Metrics:
+    """本进程里的计时直方图, 计数和读数, 导出成 Prometheus 的文本格式
+
+    labels 会加在每个样本上 (比如 task); 渲染进程池里记下的不会回到主进程
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.lock = Lock()
+        self.histograms = {}  # name -> {labels: [bucket counts, sum]}
+        self.counters = {}  # name -> {labels: value}
+        self.gauges = {}  # name -> {labels: value}
+        os.register_at_fork(after_in_child=self.forked)
+
+    def forked(self) -> None:
+        self.lock = Lock()  # Another thread may have held it at the fork
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = tuple(labels.items())
+        with self.lock:
+            h = self.histograms.setdefault(name, {}).setdefault(key, [[0] * len(BUCKETS), 0.0])
+            h[0][bisect_left(BUCKETS, seconds)] += 1
+            h[1] += seconds
+
+    def count(self, name: str, n: float = 1, **labels) -> None:
+        key = tuple(labels.items())
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + n
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(labels.items())] = value
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """给 with 块计时, 记在 span_seconds{span=name} 里"""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('span_seconds', time.perf_counter() - t, span=name, **labels)
+
+    def histogram(self, name: str) -> dict[tuple, dict]:
+        """累计的桶 (同 Prometheus), 次数和总和"""
+        with self.lock:
+            out = {}
+            for key, (counts, total) in self.histograms.get(name, {}).items():
+                n = 0
+                buckets = {}
+                for le, count in zip(BUCKETS, counts):
+                    n += count
+                    buckets[le] = n
+                out[key] = {'buckets': buckets, 'count': n, 'sum': total}
+            return out
+
+    def total(self, name: str, **labels) -> float:
+        """计数器里和 labels 相符的样本之和"""
+        with self.lock:
+            return sum(v for key, v in self.counters.get(name, {}).items() if labels.items() <= dict(key).items())
+
+    def text(self) -> str:
+        lines = []
+        for name in sorted(self.histograms):
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for key, h in self.histogram(name).items():
+                labels = {**self.labels, **dict(key)}
+                for le, n in h['buckets'].items():
+                    lines.append(f'{PREFIX}{name}_bucket{{{Labels({**labels, "le": Number(le)})}}} {n}')
+                lines.append(f'{PREFIX}{name}_sum{{{Labels(labels)}}} {Number(h["sum"])}')
+                lines.append(f'{PREFIX}{name}_count{{{Labels(labels)}}} {h["count"]}')
+        with self.lock:
+            for kind, metrics in ('counter', self.counters), ('gauge', self.gauges):
+                for name in sorted(metrics):
+                    lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                    for key, value in metrics[name].items():
+                        lines.append(f'{PREFIX}{name}{{{Labels({**self.labels, **dict(key)})}}} {Number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str) -> None:
+        """原子地写到 path, 给 node_exporter 的 textfile collector 读"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        tmp.write_text(self.text())
+        tmp.replace(path)
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """在后台线程里提供 /metrics"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = metrics.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def snapshot(self) -> tuple[dict, dict]:
+        """span 的 (次数, 总耗时) 和计数器的当前值, 给 summary 算增量"""
+        with self.lock:
+            spans = {key: (sum(counts), total) for key, (counts, total) in self.histograms.get('span_seconds', {}).items()}
+            counters = {(name, key): value for name, counter in sorted(self.counters.items()) for key, value in counter.items()}
+        return spans, counters
+
+    def summary(self, since: tuple[dict, dict] = ({}, {})) -> str:
+        """一行的运行摘要: 每种 span 的次数和总耗时, 以及计数器, 都以 label 的值区分, 如 render/body; since 是之前的 snapshot()"""
+        name = lambda *parts: '/'.join(map(str, parts))
+        spans, counters = self.snapshot()
+        parts = []
+        for key, (n, total) in spans.items():
+            n0, total0 = since[0].get(key, (0, 0.0))
+            if n > n0 and dict(key)['span'] != 'run':
+                parts.append(f'{name(*dict(key).values())} {n - n0}x {total - total0:.2f}s')
+        for (metric, key), value in counters.items():
+            if (metric, key) not in since[1] or value != since[1][metric, key]:
+                parts.append(f'{name(metric, *dict(key).values())} {value - since[1].get((metric, key), 0):g}')
+        return ', '.join(parts)
+
+    @contextmanager
+    def run(self, task: str, path: str = None):
+        """一次运行: 记下耗时, 是否成功和结束时间, 打一行这次的摘要, 有 path 时导出 (失败了也导出)
+
+        task 成为所有样本的 label, 除非已经设了 (常驻进程里跑好几种任务); run_* 总是按 task 区分
+        """
+        self.labels.setdefault('task', task)
+        since = self.snapshot()
+        t = time.perf_counter()
+        ok = False
+        try:
+            with self.span('run', task=task):
+                yield
+            ok = True
+        finally:
+            self.gauge('run_duration_seconds', time.perf_counter() - t, task=task)
+            self.gauge('run_success', int(ok), task=task)
+            self.gauge('run_timestamp_seconds', time.time(), task=task)
+            log.info('%s %s in %.1fs: %s', task, ok and 'done' or 'failed', time.perf_counter() - t, self.summary(since))
+            if path: self.export(path)
+
+
+METRICS = Metrics()
+Span = METRICS.span
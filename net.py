@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+from threading import Lock
+from urllib.parse import urlsplit
+import os
+import time
+
+from requests import RequestException, Response, Session
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+
+class CircuitOpen(RequestException):
+    """上游连续失败, 暂时不再请求"""
+
+
+class Upstream:
+    """一个 host 的熔断状态"""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.failures = 0
+        self.until = 0  # Circuit is open until this time.monotonic()
+
+
+class Client:
+    """共享的 HTTP 客户端: 每个 host 一个长连接池, 超时, 带抖动的指数退避重试, 按 host 熔断"""
+
+    def __init__(self, timeout=(5, 30), retries=3, backoff=0.5, threshold=5, cooldown=60, pool=16):
+        self.timeout = timeout  # (connect, read)
+        self.retries = retries
+        self.backoff = backoff
+        self.threshold = threshold  # Consecutive failures that open the circuit
+        self.cooldown = cooldown
+        self.pool = pool
+        self.connect()
+        self.upstreams = {}
+        os.register_at_fork(after_in_child=self.connect)  # Render workers must not share the parent's sockets or locks
+
+    def connect(self) -> None:
+        self.lock = Lock()
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=self.pool, pool_maxsize=self.pool)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def upstream(self, host: str) -> Upstream:
+        with self.lock:
+            if host not in self.upstreams: self.upstreams[host] = Upstream(host)
+            return self.upstreams[host]
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        """5xx, 429 和连接错误会重试; 其余的响应原样返回"""
+        host = urlsplit(url).hostname
+        up = self.upstream(host)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if up.until > time.monotonic():
+                METRICS.count('http_rejected_total', host=host)
+                raise CircuitOpen(f'{host} failed {up.failures} times in a row')
+            t = time.perf_counter()
+            wait = None
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except RequestException as e:
+                error = e
+            else:
+                if r.status_code < 500 and r.status_code != 429:
+                    self.observe(up, time.perf_counter() - t, False)
+                    return r
+                error = RequestException(f'{r.status_code} from {url}', response=r)
+                if r.headers.get('Retry-After', '').isdigit(): wait = min(int(r.headers['Retry-After']), self.cooldown)
+            self.observe(up, time.perf_counter() - t, True)
+            if attempt == self.retries: break
+            METRICS.count('http_retries_total', host=host)
+            time.sleep(wait if wait is not None else self.backoff * 2 ** attempt * uniform(0.5, 1.5))
+        raise error
+
+    def observe(self, up: Upstream, seconds: float, failed: bool) -> None:
+        METRICS.observe('http_request_seconds', seconds, host=up.host)
+        if failed: METRICS.count('http_errors_total', host=up.host)
+        with self.lock:
+            if failed:
+                up.failures += 1
+                if up.failures >= self.threshold:
+                    up.until = time.monotonic() + self.cooldown
+            else:
+                up.failures = 0
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> Response:
+        return self.request('POST', url, **kwargs)
+
+    def histograms(self) -> dict[str, dict]:
+        """每个 host 的请求延迟分布, 桶是累计的 (同 Prometheus)"""
+        out = {}
+        for key, h in METRICS.histogram('http_request_seconds').items():
+            host = dict(key)['host']
+            out[host] = {**h, 'errors': METRICS.total('http_errors_total', host=host)}
+        return out
+
+
+class RateLimit:
+    """每个 host 的请求速率限制"""
+
+    def __init__(self, rate: float = 0):
+        self.interval = rate and 1 / rate  # 0 means unlimited
+        self.lock = Lock()
+        self.next = {}
+
+    def __call__(self, url: str) -> None:
+        if not self.interval: return
+        host = urlsplit(url).hostname
+        with self.lock:  # Reserve a slot, then sleep outside the lock
+            now = time.monotonic()
+            at = max(now, self.next.get(host, now))
+            self.next[host] = at + self.interval
+        if at > now: time.sleep(at - now)
+
+
+def Map(fn, items, workers: int = 8) -> list:
+    """并发执行, 保持原有顺序"""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return list(map(fn, items))
+    with ThreadPoolExecutor(min(workers, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+HTTP = Client()
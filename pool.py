@@ -0,0 +1,64 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Callable, Iterable, Iterator
+
+
+def Imap(fn: Callable, items: Iterable, workers: int = 1, initializer: Callable = None, threads=False) -> Iterator:
+    """多进程 (或多线程) 执行, 按原有顺序产出结果; 同时最多有 2 * workers 个任务在途, 以限制内存"""
+    if workers <= 1:
+        if initializer: initializer()
+        yield from map(fn, items)
+        return
+    with (ThreadPoolExecutor if threads else ProcessPoolExecutor)(workers, initializer=initializer) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def Prefetch(items: Iterable, size: int = 1) -> Iterator:
+    """在后台线程中提前取出至多 size 个元素, 让上下游并行
+
+    消费者提前停下 (出错或 close) 时, 后台线程取完手上这个就退出, close 返回时它已经结束
+    """
+    queue = Queue(size)
+    end = object()
+    stop = Event()
+
+    def Put(entry) -> bool:
+        while not stop.is_set():  # A plain put would block forever once nobody reads
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def Run():
+        try:
+            for item in items:
+                if not Put((item, None)): return
+        except BaseException as e:
+            Put((end, e))
+        else:
+            Put((end, None))
+        finally:
+            if hasattr(items, 'close'): items.close()  # E.g. an Imap, which then shuts its pool down
+
+    thread = Thread(target=Run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is end:
+                if error: raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()  # So the caller may close what items was made from
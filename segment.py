@@ -0,0 +1,69 @@
+from hashlib import sha1
+from pathlib import Path
+from threading import Lock
+import logging
+import time
+
+from cache import Cache
+from pool import Imap
+
+log = logging.getLogger(__name__)
+
+DICT_CACHE = 'cache/jieba.cache'  # Prefix dictionary, reused across runs instead of /tmp
+SEGMENTS = Cache('cache/segments.db', 8192)  # Text -> segmented text
+
+lock = Lock()
+tokenizer = None
+
+
+def Tokenizer():
+    """第一次分词时才加载 jieba"""
+    global tokenizer
+    with lock:
+        if tokenizer is None:
+            import jieba
+            t = time.perf_counter()
+            path = Path(DICT_CACHE).absolute()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            jieba.setLogLevel(logging.WARNING)
+            tokenizer = jieba.Tokenizer()
+            tokenizer.tmp_dir = str(path.parent)
+            tokenizer.cache_file = path.name
+            tokenizer.initialize()
+            log.info('jieba ready in %.2fs', time.perf_counter() - t)
+    return tokenizer
+
+
+def Key(text: str) -> str:
+    return sha1(text.encode()).hexdigest()
+
+
+def Segment(texts: list[str]) -> list[str]:
+    # One cut over all texts; no text contains a newline, so the newline tokens separate them
+    out = [[]]
+    for word in Tokenizer().cut('\n'.join(texts)):
+        if word == '\n':
+            out.append([])
+        else:
+            out[-1].append(word)
+    return [' '.join(words) for words in out]
+
+
+def Cut(text: str) -> str:
+    """分词, 词之间用空格分隔"""
+    return CutAll([text])[0]
+
+
+def CutAll(texts: list[str], workers=1, batch=64) -> list[str]:
+    """批量分词, 已经缓存的文本跳过; workers > 1 时分批在多个进程里切"""
+    texts = [' '.join(text.split()) for text in texts]  # Newlines are only whitespace to Wrap anyway
+    keys = list(map(Key, texts))
+    out = [SEGMENTS.get(key) for key in keys]
+    todo = [i for i, text in enumerate(out) if text is None]
+    if todo:
+        chunks = [[texts[i] for i in todo[j:j + batch]] for j in range(0, len(todo), batch)]
+        done = [text for chunk in Imap(Segment, chunks, min(workers, len(chunks)), Tokenizer) for text in chunk]
+        for i, text in zip(todo, done):
+            out[i] = text
+            SEGMENTS.set(keys[i], text)
+    return out
@@ -0,0 +1,98 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+import logging
+import time
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+from metrics import METRICS, Span
+
+log = logging.getLogger(__name__)
+
+RATE = 20 / 60  # Messages per second, Telegram allows about 20 a minute in a group
+BURST = 20
+
+
+class Bucket:
+    """令牌桶: 平均每秒 rate 个, 最多攒 burst 个"""
+
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+        self.lock = Lock()
+
+    def take(self, n: int = 1) -> float:
+        """取 n 个令牌, 不够时等待; 返回等待的秒数"""
+        with self.lock:  # Reserve the tokens, then sleep outside the lock
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate) - min(n, self.burst)
+            self.time = now
+            wait = max(0, -self.tokens / self.rate)
+        if wait: time.sleep(wait)
+        return wait
+
+
+class Sender:
+    """按群组的限制发送到一个 chat: 相册按张数扣令牌, 429 时按 retry_after 暂停后重试; 置顶和取消置顶在后台线程里, 和上传重叠"""
+
+    def __init__(self, bot: telebot.TeleBot, chat_id: int, rate: float = RATE, burst: int = BURST, retries: int = 5):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.bucket = Bucket(rate, burst)
+        self.retries = retries
+        self.lock = Lock()
+        self.until = 0  # Telegram asked us to wait until this time.monotonic()
+        self.background = ThreadPoolExecutor(1)  # One at a time, so pins keep their order
+        self.pending = []
+        self.start = time.perf_counter()
+        self.sent = 0
+        self.throttles = 0
+        self.waited = 0.0
+
+    def __str__(self) -> str:
+        return f'{self.sent} messages in {time.perf_counter() - self.start:.1f}s, {self.throttles} throttles, {self.waited:.1f}s waiting'
+
+    def call(self, fn, *args, cost: int = 0, **kwargs):
+        for attempt in range(self.retries + 1):
+            wait = self.bucket.take(cost) if cost and not attempt else 0
+            pause = self.until - time.monotonic()
+            if pause > 0: time.sleep(pause)
+            with self.lock:
+                self.waited += wait + max(pause, 0)
+            try:
+                with Span('telegram', method=fn.__name__):
+                    return fn(*args, **kwargs)
+            except ApiTelegramException as e:
+                retry = e.error_code == 429 and (e.result_json.get('parameters') or {}).get('retry_after')
+                if not retry or attempt == self.retries: raise
+                log.warning('%s throttled, retry after %ss', e.function_name, retry)
+                METRICS.count('telegram_throttles_total')
+                with self.lock:
+                    self.throttles += 1
+                    self.until = max(self.until, time.monotonic() + retry)
+
+    def send_media_group(self, media: list) -> list[telebot.types.Message]:
+        msg = self.call(self.bot.send_media_group, self.chat_id, media, cost=len(media))
+        self.sent += len(media)
+        METRICS.count('telegram_messages_total', len(media))
+        return msg
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = self.background.submit(self.call, fn, self.chat_id, *args, **kwargs)
+        self.pending.append(future)
+        return future
+
+    def pin(self, message_id: int) -> Future:
+        return self.submit(self.bot.pin_chat_message, message_id, disable_notification=True)
+
+    def unpin(self, message_id: int) -> Future:
+        return self.submit(self.bot.unpin_chat_message, message_id)
+
+    def close(self) -> None:
+        """等后台的置顶做完, 有失败的就抛出"""
+        self.background.shutdown()
+        for future in self.pending:
+            future.result()
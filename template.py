@@ -0,0 +1,259 @@
+from argparse import ArgumentParser, Namespace
+from functools import cache
+from hashlib import sha256
+from io import BytesIO
+from math import ceil
+from typing import Callable
+import json
+import time
+
+import PIL.Image
+from PIL.ImageDraw import Draw, ImageDraw
+from PIL.ImageFont import FreeTypeFont
+
+from cache import Files
+from fonts import Box, Font, Multiline, Text
+import images
+from layout import Wrap
+from metrics import METRICS, Span
+
+VERSION = 2  # Of the drawing code, in every render cache key; bump it when cards change without their inputs changing
+
+
+@cache
+def Ascent(font: FreeTypeFont) -> tuple[int, int]:
+    """大写字母的上下边界, 用来算行高"""
+    _, t, _, b = font.getbbox('A')
+    return t, b
+
+
+def Size(box: tuple) -> tuple[int, int]:
+    l, t, r, b = box
+    return r - l, b - t
+
+
+class Template:
+    """卡片模板: 区域布局, 字体和静态底图只准备一次, 每张卡片只画变化的部分
+
+    regions 里都是 (left, top, right, bottom); 只画一行文字的区域, top 和 bottom 是基线
+    """
+
+    def __init__(self, size: tuple[int, int], background: str, fonts: dict[str, tuple[str, int]], regions: dict[str, tuple], cache: str = None):
+        self.size = size
+        self.background = background
+        self.specs = fonts
+        self.regions = regions
+        self.cache = cache and Renders(cache)
+        self.encoder = Encoder()
+        self._fonts = None
+        self._base = None
+
+    @property
+    def fonts(self) -> dict[str, FreeTypeFont]:
+        if self._fonts is None:  # Loaded on first use, once per process, each with its fallbacks
+            self._fonts = {name: Font(*spec) for name, spec in self.specs.items()}
+        return self._fonts
+
+    @property
+    def base(self) -> PIL.Image.Image:
+        if self._base is None:
+            self._base = PIL.Image.new('RGB', self.size, self.background)
+        return self._base
+
+    def load(self) -> None:
+        """给进程池的 initializer 用"""
+        self.fonts, self.base
+
+    def new(self, cover: str | None) -> tuple[PIL.Image.Image, ImageDraw]:
+        """底图加上封面缩略图和模糊背景; cover 为 None 时 (下载不了) 只有底色"""
+        image = self.base.copy()
+        if cover is None: return image, Draw(image)
+        boxes = self.regions['thumb'], self.regions['panel']
+        for part, box in zip(images.COVERS.get_panels(cover, *(Size(box) for box in boxes)), boxes):
+            image.paste(part, box[:2])
+        return image, Draw(image)
+
+    def render(self, head: dict, body: dict, Body: Callable[[], PIL.Image.Image], Head: Callable[[ImageDraw], object]) -> bytes:
+        """Body() 画出除头部外的整张卡片, Head(draw) 再画上头部; head 和 body 是它们各自用到的全部输入"""
+        if self.cache is None:
+            with Span('render', section='body'):
+                image = Body()
+            with Span('render', section='head'):
+                Head(Draw(image))
+            with Span('render', section='encode'):
+                return self.encoder(image)
+        salt = VERSION, self.size, self.background, self.specs, [font.files for font in self.fonts.values()], self.regions, images.COVERS.fast, repr(self.encoder)
+        return self.cache.render(salt, head, body, Body, Head, self.encoder)
+
+
+class Renders:
+    """渲染缓存: 输入没变的卡片直接读盘; 只有头部变了的, 在缓存的底图上重画头部"""
+
+    def __init__(self, root: str, age: float = 14 * 86400):
+        self.files = Files(root, age)
+        self.hits = 0
+        self.patched = 0
+        self.misses = 0
+
+    def __str__(self) -> str:
+        return f'{self.files.root.name}: {self.hits} hits, {self.patched} patched, {self.misses} misses'
+
+    def render(self, salt, head: dict, body: dict, Body, Head, encode) -> bytes:
+        base = Key(salt, body)
+        card = self.files.path(Key(base, head), '.card')
+        if data := self.files.read(card):
+            self.hits += 1
+            METRICS.count('render_cache_total', result='hit')
+            return data
+        path = self.files.path(base, '.base.png')
+        if data := self.files.read(path):
+            self.patched += 1
+            METRICS.count('render_cache_total', result='patched')
+            with Span('render', section='base'):
+                image = PIL.Image.open(BytesIO(data))
+                image.load()
+        else:
+            self.misses += 1
+            METRICS.count('render_cache_total', result='miss')
+            with Span('render', section='body'):
+                image = Body()
+                self.files.write(path, Encode(image, 1))  # Only ever read back here, so favour speed over size
+        with Span('render', section='head'):
+            Head(Draw(image))
+        with Span('render', section='encode'):
+            data = encode(image)
+        self.files.write(card, data)
+        return data
+
+    def prune(self) -> None:
+        self.files.prune()
+
+
+class Encoder:
+    """卡片的输出格式: png 无损; jpeg 和 webp 有损但小得多; auto 每张卡片分别挑, 不超过 budget 字节时依次优先无损, 调色板 png, 否则取最小的
+
+    colors 不为 0 时 png 先量化成调色板, auto 的调色板 png 没给时用 256 色; 每次编码的字节数和耗时都记在 stats 里 (每个进程各记各的)
+    """
+    FORMATS = 'png', 'jpeg', 'webp', 'auto'
+
+    def __init__(self, format: str = 'png', level: int = 6, optimize: bool = False, colors: int = 0, quality: int = 90, budget: int = 0):
+        assert format in self.FORMATS, format
+        self.format = format
+        self.level = level
+        self.optimize = optimize  # Slow; overrides level with 9 plus filter search
+        self.colors = colors
+        self.quality = quality
+        self.budget = budget
+        self.stats = {}  # Name -> [tried, chosen, bytes, seconds]
+
+    @staticmethod
+    def add_arguments(parser: ArgumentParser) -> None:
+        """各个脚本共用的编码参数, 用 from_args 取回"""
+        parser.add_argument('--format', choices=Encoder.FORMATS, default='png', help='card encoding, auto picks one per card')
+        parser.add_argument('--quality', type=int, default=90, help='for jpeg and webp')
+        parser.add_argument('--budget', type=int, default=0, help='with auto, KiB a card may take before lossy formats are tried')
+        parser.add_argument('--colors', type=int, default=0, help='quantize png to this many colours, auto tries 256 when not given')
+        parser.add_argument('--level', type=int, default=6, help='png compression level')
+        parser.add_argument('--optimize', action='store_true', help='slow png compression with filter search')
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> 'Encoder':
+        return cls(args.format, args.level, args.optimize, args.colors, args.quality, args.budget * 1024)
+
+    def __repr__(self) -> str:
+        return f'Encoder({self.format!r}, level={self.level}, optimize={self.optimize}, colors={self.colors}, quality={self.quality}, budget={self.budget})'
+
+    def __str__(self) -> str:
+        return ', '.join(f'{name} {chosen}/{tried} chosen, {size / tried / 1024:.0f} KiB {t / tried * 1e3:.0f} ms avg' for name, (tried, chosen, size, t) in self.stats.items())
+
+    def __call__(self, image: PIL.Image.Image) -> bytes:
+        if self.format == 'png':
+            return self.choose(self.png(image, self.colors))
+        if self.format != 'auto':
+            return self.choose(self.lossy(image, self.format, self.quality))
+        best = None
+        for colors in 0, self.colors or 256:  # Text stays sharp in both
+            out = self.png(image, colors)
+            if best is None or len(out[1]) < len(best[1]): best = out
+            if self.budget and len(out[1]) <= self.budget:
+                return self.choose(out)
+        # Lower qualities only to get within the budget, and not below 70
+        for quality in [self.quality, *range(self.quality - 5, 69, -5)] if self.budget else [self.quality]:
+            for format in 'jpeg', 'webp':
+                out = self.lossy(image, format, quality)
+                if len(out[1]) < len(best[1]): best = out
+            if len(best[1]) <= self.budget: break
+        return self.choose(best)
+
+    def png(self, image: PIL.Image.Image, colors: int = 0) -> tuple[str, bytes]:
+        name = 'png'
+        if colors:
+            name = f'png{colors}'
+            t = time.perf_counter()
+            image = image.quantize(colors)
+            self.stats.setdefault(name, [0, 0, 0, 0.0])[3] += time.perf_counter() - t
+        return self.save(name, image, 'PNG', compress_level=self.level, optimize=self.optimize)
+
+    def lossy(self, image: PIL.Image.Image, format: str, quality: int) -> tuple[str, bytes]:
+        if format == 'jpeg':  # No chroma subsampling, coloured text stays sharp
+            return self.save(f'jpeg{quality}', image, 'JPEG', quality=quality, optimize=True, subsampling=0)
+        return self.save(f'webp{quality}', image, 'WEBP', quality=quality)
+
+    def save(self, name: str, image: PIL.Image.Image, format: str, **params) -> tuple[str, bytes]:
+        t = time.perf_counter()
+        file = BytesIO()
+        image.save(file, format, **params)
+        data = file.getvalue()
+        stats = self.stats.setdefault(name, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[2] += len(data)
+        stats[3] += time.perf_counter() - t
+        return name, data
+
+    def choose(self, out: tuple[str, bytes]) -> bytes:
+        self.stats[out[0]][1] += 1
+        return out[1]
+
+
+def Key(*parts) -> str:
+    return sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def Line(draw: ImageDraw, x: float, yt: float, text: str, font: FreeTypeFont, fill, margin: float) -> float:
+    """从上往下画一行, 返回下一行的 yt; draw 为 None 时只算位置"""
+    t, b = Ascent(font)
+    yt += b - t
+    if draw: Text(draw, (x, yt), text, fill, font)
+    return yt + margin
+
+
+def Stack(draw: ImageDraw, x: float, yb: float, lines: list[str], font: FreeTypeFont, fill, spacing: float, margin: float, join='\n') -> float:
+    """从下往上画一段, 返回上一段的 yb"""
+    t, b = Ascent(font)
+    yb -= (len(lines) - 1) * (b - t + spacing)
+    Multiline(draw, (x, yb), join.join(lines), fill, font, 'ls', spacing - t)
+    return yb - (b - t) - margin
+
+
+def Fill(draw: ImageDraw, x: float, yt: float, yb: float, text: str, width: float, font: FreeTypeFont, fill, spacing: float, **wrap) -> None:
+    """用 text 填满 yt 和 yb 之间的空间"""
+    t, b = Ascent(font)
+    yt += b - t
+    lines = Wrap(text, width, font, ceil((yb - yt + spacing) / (b - t + spacing)), **wrap)
+    Multiline(draw, (x, yt), '\n'.join(lines), fill, font, 'ls', spacing - t)
+
+
+def Tags(draw: ImageDraw, x: float, y: float, xr: float, tags: list[str], font: FreeTypeFont, fill, border=7) -> None:
+    for tag in tags:
+        l, _, r, _ = Box(font, tag)
+        l, r = l + x, r + x
+        if r + 2 * border > xr: break  # Exceeding tags are dropped
+        draw.rectangle((l, y - border, r + 2 * border, y + border), fill)
+        Text(draw, (l + border, y), tag, 'white', font)
+        x += r - l + border * 4  # Move right
+
+
+def Encode(image: PIL.Image.Image, level: int = 6) -> bytes:
+    file = BytesIO()
+    image.save(file, 'PNG', compress_level=level)  # .tobytes() is not for this
+    return file.getvalue()